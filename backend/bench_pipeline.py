@@ -0,0 +1,191 @@
+"""
+Benchmarks the memory pipeline end to end against the local mock Groq server.
+
+Fills an in-memory database with generated transcriptions, queues them as
+batch jobs and runs queue workers, as the API server does, until every
+batch is committed, then reports the time spent in each stage, the LLM calls and tokens, and the
+peak memory use.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from job_queue import JobQueue, Worker
+from llm import GroqClient, GroqModelConfig
+from local_database import InMemoryDatabase
+from memory_manager import BATCH_JOB, MemoryManager
+from mock_groq import MockGroqServer
+
+# (subject, things said about it) used to generate the fixture conversations
+FIXTURE_TOPICS = [
+    ("hiking trip", ["the trail up the mountain", "packing enough water", "leaving at six"]),
+    ("dinner plans", ["making pasta tonight", "buying fresh basil", "inviting the neighbours"]),
+    ("job interview", ["the bank on Friday", "practising answers", "what to wear"]),
+    ("birthday party", ["a chocolate cake", "the guest list", "renting a small hall"]),
+    ("new puppy", ["the vet appointment", "house training", "a name for her"]),
+]
+FIXTURE_OPENERS = ["I think", "Did you hear about", "We should talk about", "Remember"]
+
+# MemoryProcessor and MemoryManager methods timed as pipeline stages
+PROCESSOR_STAGES = [
+    "analyze_transcriptions",
+    "plan_memory_updates",
+    "plan_and_execute_memory_updates",
+    "execute_memory_updates",
+    "generate_memory_updates_fast",
+    "_execute_memory_block",
+]
+MANAGER_STAGES = [
+    "enqueue_batches", "run_batch_job", "commit_batch_job", "_apply_batch", "_apply_updates"
+]
+# job statuses that mean a batch is not finished yet
+UNFINISHED = ("pending", "running", "ready", "committing")
+
+
+def fixture_transcriptions(count: int, seed: int = 0) -> list[dict]:
+    """Generate ``count`` transcriptions that drift between topics, one sentence each."""
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1, 12, 0, 0)
+    transcriptions = []
+    subject, details = rng.choice(FIXTURE_TOPICS)
+    for i in range(count):
+        if rng.random() < 0.15:
+            subject, details = rng.choice(FIXTURE_TOPICS)
+        text = f"{rng.choice(FIXTURE_OPENERS)} the {subject}, {rng.choice(details)}."
+        timestamp = (start + timedelta(seconds=5 * i)).strftime("%Y-%m-%d %H-%M-%S")
+        transcriptions.append({"text": text, "timestamp": timestamp})
+    return transcriptions
+
+
+_stages_lock = threading.Lock()
+
+
+def _timed(stages: dict, name: str, func):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with _stages_lock:
+                stages[name] = stages.get(name, 0.0) + time.perf_counter() - started
+    return wrapper
+
+
+def run_benchmark(
+    server: MockGroqServer, sentences: int, mode: str, stream: bool, workers: int = 1
+) -> dict:
+    """Process ``sentences`` generated transcriptions and return the measurements."""
+    db = InMemoryDatabase()
+    db.create_transcriptions(fixture_transcriptions(sentences))
+    client = GroqClient(GroqModelConfig(temperature=0.3, base_url=server.url))
+    manager = MemoryManager(db=db, client=client)
+    manager.pipeline_mode = mode
+    manager.processor.stream = stream
+
+    stages = {}
+    for name in PROCESSOR_STAGES:
+        setattr(manager.processor, name, _timed(stages, name, getattr(manager.processor, name)))
+    for name in MANAGER_STAGES:
+        setattr(manager, name, _timed(stages, name, getattr(manager, name)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        queue = JobQueue(os.path.join(directory, "jobs.db"))
+        tracemalloc.start()
+        started = time.perf_counter()
+        manager.enqueue_batches(queue)
+        threads = [
+            Worker(
+                queue, BATCH_JOB, manager.run_batch_job, manager.commit_batch_job,
+                poll_interval=0.05,
+            ).start()
+            for _ in range(workers)
+        ]
+        while any(status in UNFINISHED for status in queue.counts(BATCH_JOB)):
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        for worker in threads:
+            worker.stop()
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        failed = queue.counts(BATCH_JOB).get("failed", 0)
+        queue.close()
+
+    return {
+        "sentences": sentences,
+        "mode": mode,
+        "stream": stream,
+        "workers": workers,
+        "seconds": round(elapsed, 3),
+        "stages": {name: round(seconds, 3) for name, seconds in stages.items()},
+        "calls": client.usage["calls"],
+        "prompt_tokens": client.usage["prompt_tokens"],
+        "completion_tokens": client.usage["completion_tokens"],
+        "processed": manager.processing_stats["total_processed"],
+        "memories": len(db.get_memories() or {}),
+        "db_reads": db.stats["reads"],
+        "db_writes": db.stats["writes"],
+        "peak_traced_mb": round(peak / 2**20, 2),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "error": f"{failed} batches failed" if failed else None,
+    }
+
+
+def main():
+    """Run the benchmark for each batch size and print a summary."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--mode", choices=["auto", "fast", "staged"], default="auto")
+    parser.add_argument("--no-stream", action="store_true", help="wait for whole responses")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="queue workers, 1 commits batch by batch"
+    )
+    parser.add_argument("--latency", type=float, default=0.2, help="mock seconds per call")
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=1000, help="mock completion speed"
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    # the Groq client wants a key even though the mock server ignores it
+    os.environ.setdefault("GROQ_API_KEY", "mock")
+    server = MockGroqServer(latency=args.latency, tokens_per_second=args.tokens_per_second)
+    server.start()
+    try:
+        results = [
+            run_benchmark(server, sentences, args.mode, not args.no_stream, args.workers)
+            for sentences in args.sizes
+        ]
+    finally:
+        server.stop()
+
+    print("\n=== PIPELINE BENCHMARK ===")
+    print(
+        f"{'sentences':>9} {'seconds':>8} {'calls':>6} {'prompt':>8} {'completion':>10} "
+        f"{'memories':>8} {'peak MB':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['sentences']:>9} {result['seconds']:>8} {result['calls']:>6} "
+            f"{result['prompt_tokens']:>8} {result['completion_tokens']:>10} "
+            f"{result['memories']:>8} {result['peak_traced_mb']:>8}"
+        )
+        for name, seconds in sorted(result["stages"].items(), key=lambda item: -item[1]):
+            print(f"{'':>9} {name}: {seconds}s")
+        if result["error"]:
+            print(f"{'':>9} error: {result['error']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Splits long segments into overlapping windows and stitches their text back together.
+"""
+
+import re
+
+import numpy as np
+
+_WORD = re.compile(r"[\w']+")
+
+
+def split_windows(
+    audio: np.ndarray, rate: int, window: float, overlap: float
+) -> list[tuple[float, np.ndarray]]:
+    """
+    Cut audio into windows of ``window`` seconds that overlap by ``overlap``.
+
+    Returns ``(offset_seconds, samples)`` pairs; the samples are views.
+    """
+    size = int(window * rate)
+    step = int((window - overlap) * rate)
+    if step <= 0:
+        raise ValueError("Window overlap must be shorter than the window")
+    if len(audio) <= size:
+        return [(0.0, audio)]
+
+    windows = []
+    start = 0
+    while True:
+        windows.append((start / rate, audio[start:start + size]))
+        if start + size >= len(audio):
+            return windows
+        start += step
+
+
+def window_text(
+    result: dict, index: int, count: int, window: float, overlap: float
+) -> str:
+    """
+    Text of one window with the overlap shared with its neighbours cut at the middle.
+
+    Whisper pieces that mostly fall into the first half of the leading overlap
+    belong to the previous window, and those in the second half of the
+    trailing overlap to the next one.
+    """
+    if "segments" not in result:
+        return result.get("text", "").strip()
+
+    low = overlap / 2 if index > 0 else float("-inf")
+    high = window - overlap / 2 if index < count - 1 else float("inf")
+    kept = [
+        piece["text"]
+        for piece in result["segments"]
+        if low <= (piece["start"] + piece["end"]) / 2 < high
+    ]
+    return "".join(kept).strip()
+
+
+def merge_seam(previous: str, text: str, max_words: int = 20, min_words: int = 2) -> str:
+    """
+    Drop the start of ``text`` if it repeats the end of ``previous``.
+
+    Compares up to ``max_words`` words, ignoring case and punctuation, and
+    removes the longest run of at least ``min_words`` words that ends
+    ``previous`` and starts ``text``.
+    """
+    previous_words = [word.lower() for word in _WORD.findall(previous)][-max_words:]
+    matches = list(_WORD.finditer(text))
+    words = [match.group().lower() for match in matches[:max_words]]
+
+    for length in range(min(len(previous_words), len(words)), min_words - 1, -1):
+        if previous_words[-length:] == words[:length]:
+            return text[matches[length - 1].end():].lstrip(" ,.;:!?-").strip()
+    return text.strip()
@@ -5,7 +5,10 @@ Database class for the application.
 import os
 import time
 import json
+import random
+import threading
 import http.client
+from types import SimpleNamespace
 
 import requests
 from firebase_admin import db
@@ -17,27 +20,276 @@ from requests_toolbelt import MultipartEncoder
 
 load_dotenv()
 
-cred = credentials.Certificate(os.getenv("FIREBASE_CREDENTIALS_PATH"))
-firebase_admin.initialize_app(
-    cred,
-    {
-        "databaseURL": os.getenv("FIREBASE_DATABASE_URL"),
-    },
-)
+_firebase_lock = threading.Lock()
 
-print("Database url:", os.getenv("FIREBASE_DATABASE_URL"))
 
+def init_firebase():
+    """
+    Connect to Firebase the first time a Database is created, so importing
+    this module does not need credentials.
+    """
+    with _firebase_lock:
+        if firebase_admin._apps:  # pylint: disable=protected-access
+            return
+        cred = credentials.Certificate(os.getenv("FIREBASE_CREDENTIALS_PATH"))
+        firebase_admin.initialize_app(
+            cred,
+            {
+                "databaseURL": os.getenv("FIREBASE_DATABASE_URL"),
+            },
+        )
+
+        print("Database url:", os.getenv("FIREBASE_DATABASE_URL"))
+
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+_push_lock = threading.Lock()
+_last_push_time = 0
+_last_random_chars = [0] * 12
+
+
+def generate_push_id() -> str:
+    """
+    Generate a Firebase push key without a round trip to the server.
+
+    Same format as the keys push() creates: 8 characters of millisecond
+    timestamp followed by 12 random characters, incremented instead of
+    re-rolled within the same millisecond so keys always sort in creation
+    order.
+    """
+    # pylint: disable=global-statement
+    global _last_push_time
+    with _push_lock:
+        now = int(time.time() * 1000)
+        if now == _last_push_time:
+            for i in range(11, -1, -1):
+                if _last_random_chars[i] < 63:
+                    _last_random_chars[i] += 1
+                    break
+                _last_random_chars[i] = 0
+        else:
+            _last_push_time = now
+            for i in range(12):
+                _last_random_chars[i] = random.randrange(64)
+
+        timestamp_chars = []
+        for _ in range(8):
+            timestamp_chars.append(PUSH_CHARS[now % 64])
+            now //= 64
+        return "".join(reversed(timestamp_chars)) + "".join(
+            PUSH_CHARS[i] for i in _last_random_chars
+        )
+
+
+def _with_child(node, parts: list[str], value):
+    """A copy of ``node`` with the value at the ``parts`` path below it replaced."""
+    node = dict(node) if isinstance(node, dict) else {}
+    if len(parts) == 1:
+        if value is None:
+            node.pop(parts[0], None)
+        else:
+            node[parts[0]] = value
+    else:
+        node[parts[0]] = _with_child(node.get(parts[0]), parts[1:], value)
+    # Firebase drops empty nodes
+    return node or None
+
+
+class WriteBatch:
+    """
+    Collects writes and applies them in a single multi-location update.
+
+    Firebase rejects an update in which one path is inside another, so a
+    write inside a path that is already written is folded into that write,
+    and a write over a path drops the earlier writes inside it.
+    """
+
+    def __init__(self, root_ref):
+        self.root_ref = root_ref
+        self.updates = {}
+
+    def __len__(self) -> int:
+        return len(self.updates)
+
+    def create(self, path: str, data: dict) -> str:
+        """Add a new child under ``path`` and return its push key."""
+        key = generate_push_id()
+        self._write(f"{path}/{key}", data)
+        return key
+
+    def update(self, path: str, key: str, data: dict):
+        """Set the given fields of ``path/key``, leaving other fields alone."""
+        for field, value in data.items():
+            self._write(f"{path}/{key}/{field}", value)
+
+    def delete(self, path: str, key: str):
+        """Remove ``path/key``."""
+        self._write(f"{path}/{key}", None)
+
+    def set(self, path: str, value):
+        """Replace whatever is at ``path``."""
+        self._write(path, value)
+
+    def _write(self, path: str, value):
+        parts = [part for part in path.split("/") if part]
+        path = "/".join(parts)
+        for written in [p for p in self.updates if p.startswith(f"{path}/")]:
+            del self.updates[written]
+        for depth in range(len(parts) - 1, 0, -1):
+            ancestor = "/".join(parts[:depth])
+            if ancestor in self.updates:
+                self.updates[ancestor] = _with_child(
+                    self.updates[ancestor], parts[depth:], value
+                )
+                return
+        self.updates[path] = value
+
+    def commit(self):
+        """Send all collected writes in one request."""
+        if self.updates:
+            self.root_ref.update(self.updates)
+            self.updates = {}
+
+
+class BaseDatabase:
+    """
+    Reads, writes and bulk helpers shared by Database and InMemoryDatabase.
 
-class Database:
+    Subclasses provide ``_read(path)`` and a ``root_ref`` whose ``update``
+    applies a multi-location update; every write goes through a WriteBatch.
+    """
+    root_ref = None
+
+    def _read(self, path: str):
+        raise NotImplementedError
+
+    def batch(self) -> WriteBatch:
+        """
+        Start a batch of writes that is sent in a single request.
+        """
+        return WriteBatch(self.root_ref)
+
+    def get_transcription(self, transcription_id: str):
+        """
+        Get a transcription from the database.
+        """
+        return self._read(f"transcriptions/{transcription_id}")
+
+    def create_transcription(self, data: dict):
+        """
+        Create a transcription, returning an object with its ``key`` like push().
+        """
+        return SimpleNamespace(key=self.create_transcriptions([data])[0])
+
+    def delete_transcription(self, transcription_id: str):
+        """
+        Delete a transcription from the database.
+        """
+        self.delete_transcriptions([transcription_id])
+
+    def create_transcriptions(self, items: list[dict]) -> list[str]:
+        """
+        Create several transcriptions in one request and return their keys.
+        """
+        batch = self.batch()
+        keys = [batch.create("transcriptions", data) for data in items]
+        batch.commit()
+        return keys
+
+    def delete_transcriptions(self, transcription_ids):
+        """
+        Delete several transcriptions in one request.
+        """
+        batch = self.batch()
+        for transcription_id in transcription_ids:
+            batch.delete("transcriptions", transcription_id)
+        batch.commit()
+
+    def get_cursor(self, name: str):
+        """
+        Get the position a consumer has read the transcriptions up to.
+        """
+        return self._read(f"cursors/{name}")
+
+    def get_applied_batch(self, key: str):
+        """
+        Get the record of a queued batch of transcriptions that has been applied.
+        """
+        return self._read(f"applied_batches/{key}")
+
+    def get_memories(self):
+        """
+        Get all memories from the database.
+        """
+        return self._read("memories")
+
+    def get_memory(self, memory_id: str):
+        """
+        Get a memory from the database.
+        """
+        return self._read(f"memories/{memory_id}")
+
+    def create_memory(self, data: dict):
+        """
+        Create a memory, returning an object with its ``key`` like push().
+        """
+        return SimpleNamespace(key=self.create_memories([data])[0])
+
+    def update_memory(self, memory_id: str, data: dict):
+        """
+        Update the given fields of a memory.
+        """
+        self.update_memories({memory_id: data})
+
+    def delete_memory(self, memory_id: str):
+        """
+        Delete a memory from the database.
+        """
+        self.delete_memories([memory_id])
+
+    def create_memories(self, items: list[dict]) -> list[str]:
+        """
+        Create several memories in one request and return their keys.
+        """
+        batch = self.batch()
+        keys = [batch.create("memories", data) for data in items]
+        batch.commit()
+        return keys
+
+    def update_memories(self, updates: dict):
+        """
+        Update several memories, given as {memory_id: data}, in one request.
+        """
+        batch = self.batch()
+        for memory_id, data in updates.items():
+            batch.update("memories", memory_id, data)
+        batch.commit()
+
+    def delete_memories(self, memory_ids):
+        """
+        Delete several memories in one request.
+        """
+        batch = self.batch()
+        for memory_id in memory_ids:
+            batch.delete("memories", memory_id)
+        batch.commit()
+
+
+class Database(BaseDatabase):
     """
     Database class for the application.
     """
 
     def __init__(self):
+        init_firebase()
         self.transcriptions_ref = db.reference("transcriptions/")
         self.memories_ref = db.reference("memories/")
+        self.root_ref = db.reference("/")
         self.uploadthing_token = os.getenv("UPLOADTHING_TOKEN")
 
+    def _read(self, path: str):
+        return self.root_ref.child(path).get()
+
     def upload_image(self, image_url: str) -> str:
         """
         Upload an image to Uploadthing and return its public URL.
@@ -175,53 +427,39 @@ class Database:
             )
         return self.transcriptions_ref.get()
 
-    def get_transcription(self, transcription_id: str):
+    def get_transcriptions_after(self, key: str | None, limit: int):
         """
-        Get a transcription from the database.
+        Get up to ``limit`` transcriptions with keys after ``key``, oldest first.
+        Push keys sort by creation time, so this reads forward through the
+        transcriptions in the order they were written.
         """
-        return self.transcriptions_ref.child(transcription_id).get()
-
-    def create_transcription(self, data: dict):
-        """
-        Create a transcription in the database.
-        """
-        return self.transcriptions_ref.push(data)
-
-    def delete_transcription(self, transcription_id: str):
-        """
-        Delete a transcription from the database.
+        query = self.transcriptions_ref.order_by_key()
+        if key is None:
+            return query.limit_to_first(limit).get() or {}
+        # start_at is inclusive, so ask for one more in case ``key`` still exists
+        transcriptions = query.start_at(key).limit_to_first(limit + 1).get() or {}
+        transcriptions.pop(key, None)
+        return dict(list(transcriptions.items())[:limit])
+
+    def get_transcriptions_between(self, after: str | None, last: str):
         """
-        self.transcriptions_ref.child(transcription_id).delete()
-
-    def get_memories(self):
+        Get the transcriptions with keys after ``after`` up to and including
+        ``last``, oldest first, however many were written in between.
         """
-        Get all memories from the database.
+        query = self.transcriptions_ref.order_by_key()
+        if after is not None:
+            query = query.start_at(after)
+        transcriptions = query.end_at(last).get() or {}
+        transcriptions.pop(after, None)
+        return transcriptions
+
+    def get_transcriptions_until(self, key: str, limit: int):
         """
-        return self.memories_ref.get()
-
-    def get_memory(self, memory_id: str):
-        """
-        Get a memory from the database.
-        """
-        return self.memories_ref.child(memory_id).get()
-
-    def create_memory(self, data: dict):
-        """
-        Create a memory in the database.
-        """
-        return self.memories_ref.push(data)
-
-    def update_memory(self, memory_id: str, data: dict):
-        """
-        Update a memory in the database.
-        """
-        self.memories_ref.child(memory_id).update(data)
-
-    def delete_memory(self, memory_id: str):
-        """
-        Delete a memory from the database.
+        Get up to ``limit`` of the oldest transcriptions with keys up to and
+        including ``key``.
         """
-        self.memories_ref.child(memory_id).delete()
+        query = self.transcriptions_ref.order_by_key().end_at(key)
+        return query.limit_to_first(limit).get() or {}
 
 
 if __name__ == "__main__":
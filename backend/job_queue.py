@@ -0,0 +1,413 @@
+"""
+Durable job queue in SQLite, shared by worker threads and processes on one machine.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from rate_limit import backoff_delay
+from tracing import count, span
+
+
+class LeaseLost(Exception):
+    """
+    Raised when a worker no longer holds the lease on the job it is working on.
+    """
+
+
+@dataclass
+class Job:
+    """
+    A claimed job. ``renew`` extends the lease and says whether it is still held.
+    """
+    id: int
+    kind: str
+    key: str
+    payload: dict
+    status: str
+    attempts: int
+    max_attempts: int
+    worker: str
+    result: Any = None
+    queue: Optional["JobQueue"] = field(default=None, repr=False)
+
+    def renew(self) -> bool:
+        """Extend the lease, False if another worker has taken the job over."""
+        return self.queue.renew(self)
+
+
+class JobQueue:
+    """
+    Jobs that survive restarts, each run to completion by one worker at a time.
+
+    A job is identified by an idempotency key, so queueing the same work
+    twice is a no-op. Work happens in two phases: ``claim`` hands out
+    pending jobs to run side by side, and ``claim_in_order`` hands out the
+    oldest unfinished job of a kind once its result is ready, so results
+    are committed one at a time in the order the jobs were queued.
+
+    Claims hold a lease that the worker renews while it works. A worker
+    that dies loses its lease and the job is handed out again, failed jobs
+    are retried with backoff until ``max_attempts`` and then kept as
+    failed, and the jobs after them carry on.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        path: str,
+        lease_seconds: float = 300.0,
+        max_attempts: int = 5,
+        retry_base: float = 10.0,
+        retry_max: float = 600.0,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._lock = threading.Lock()
+        # transactions are started explicitly, so claims can lock the database
+        self._conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                result TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                run_after REAL NOT NULL,
+                lease_owner TEXT,
+                lease_until REAL,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_kind_status ON jobs (kind, status, id)"
+        )
+
+    @contextmanager
+    def _transaction(self):
+        """Hold the write lock of the database file, across processes."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _job(self, row, worker: str = "") -> Job:
+        return Job(
+            id=row[0],
+            kind=row[1],
+            key=row[2],
+            payload=json.loads(row[3]),
+            status=row[4],
+            attempts=row[5],
+            max_attempts=row[6],
+            worker=worker,
+            result=json.loads(row[7]) if row[7] is not None else None,
+            queue=self,
+        )
+
+    _COLUMNS = "id, kind, key, payload, status, attempts, max_attempts, result"
+
+    def enqueue(
+        self, kind: str, key: str, payload: dict, max_attempts: Optional[int] = None
+    ) -> bool:
+        """Queue a job, False if a job with this key was queued before."""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO jobs "
+                "(kind, key, payload, max_attempts, run_after, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, key, json.dumps(payload), max_attempts or self.max_attempts, now, now, now),
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, worker: str, kind: str) -> Optional[Job]:
+        """Lease the oldest job that is due to run, or one whose worker has gone."""
+        now = time.time()
+        with self._transaction() as conn:
+            # a job that keeps taking its worker down is not handed out forever
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', lease_owner = NULL, updated = ?, "
+                "error = 'Lease expired on the last attempt' "
+                "WHERE kind = ? AND status = 'running' AND lease_until < ? "
+                "AND attempts >= max_attempts",
+                (now, kind, now),
+            )
+            row = conn.execute(
+                f"SELECT {self._COLUMNS} FROM jobs WHERE kind = ? AND ("
+                "(status = 'pending' AND run_after <= ?) "
+                "OR (status = 'running' AND lease_until < ?)"
+                ") ORDER BY id LIMIT 1",
+                (kind, now, now),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                "lease_owner = ?, lease_until = ?, updated = ? WHERE id = ?",
+                (worker, now + self.lease_seconds, now, row[0]),
+            )
+        job = self._job(row, worker)
+        job.status = "running"
+        job.attempts += 1
+        return job
+
+    def claim_in_order(self, worker: str, kind: str) -> Optional[Job]:
+        """
+        Lease the oldest unfinished job of a kind for committing, if its result
+        is ready. Only one job of a kind can be committing at a time.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                f"SELECT {self._COLUMNS}, lease_until FROM jobs "
+                "WHERE kind = ? AND status NOT IN ('done', 'failed') ORDER BY id LIMIT 1",
+                (kind,),
+            ).fetchone()
+            if row is None or not (
+                row[4] == "ready" or (row[4] == "committing" and row[8] < now)
+            ):
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'committing', lease_owner = ?, lease_until = ?, "
+                "updated = ? WHERE id = ?",
+                (worker, now + self.lease_seconds, now, row[0]),
+            )
+        job = self._job(row, worker)
+        job.status = "committing"
+        return job
+
+    def _update(self, job: Job, sql: str, *params) -> bool:
+        """Run an update on a job the worker still holds the lease of."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET {sql}, updated = ? "
+                "WHERE id = ? AND lease_owner = ? AND status = ?",
+                (*params, time.time(), job.id, job.worker, job.status),
+            )
+        return cursor.rowcount == 1
+
+    def renew(self, job: Job) -> bool:
+        """Extend the lease on a job, False if it has been lost."""
+        return self._update(job, "lease_until = ?", time.time() + self.lease_seconds)
+
+    def finish(self, job: Job, result) -> bool:
+        """Store the result of a running job, ready to be committed."""
+        ok = self._update(
+            job, "status = 'ready', result = ?, lease_owner = NULL, error = NULL",
+            json.dumps(result),
+        )
+        if ok:
+            job.status = "ready"
+        return ok
+
+    def complete(self, job: Job) -> bool:
+        """Mark a committed job as done."""
+        ok = self._update(job, "status = 'done', result = NULL, lease_owner = NULL")
+        if ok:
+            job.status = "done"
+        return ok
+
+    def fail(self, job: Job, error: str) -> bool:
+        """Retry a job after a backoff, or give up on it after its last attempt."""
+        if job.attempts >= job.max_attempts:
+            ok = self._update(
+                job, "status = 'failed', result = NULL, lease_owner = NULL, error = ?", error
+            )
+            status = "failed"
+        else:
+            delay = backoff_delay(job.attempts, self.retry_base, self.retry_max)
+            ok = self._update(
+                job,
+                "status = 'pending', result = NULL, lease_owner = NULL, error = ?, "
+                "run_after = ?",
+                error,
+                time.time() + delay,
+            )
+            status = "pending"
+        if ok:
+            job.status = status
+        return ok
+
+    def retry_failed(self, kind: str) -> int:
+        """Queue the failed jobs of a kind again, with fresh attempts."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'pending', attempts = 0, run_after = ?, updated = ? "
+                "WHERE kind = ? AND status = 'failed'",
+                (time.time(), time.time(), kind),
+            )
+        return cursor.rowcount
+
+    def unfinished(self, kind: str) -> list[Job]:
+        """The jobs of a kind that are not done, failed ones included, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {self._COLUMNS} FROM jobs WHERE kind = ? AND status != 'done' "
+                "ORDER BY id",
+                (kind,),
+            ).fetchall()
+        return [self._job(row) for row in rows]
+
+    def counts(self, kind: Optional[str] = None) -> dict:
+        """Number of jobs in each status."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs "
+                + ("WHERE kind = ? " if kind else "")
+                + "GROUP BY status",
+                (kind,) if kind else (),
+            ).fetchall()
+        return dict(rows)
+
+    def purge(self, older_than: float) -> int:
+        """Delete jobs that were done more than ``older_than`` seconds ago."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "DELETE FROM jobs WHERE status = 'done' AND updated < ?",
+                (time.time() - older_than,),
+            )
+        return cursor.rowcount
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
+
+
+class Worker:
+    """
+    Runs the jobs of one kind from a background thread.
+
+    ``run(job)`` does the work and returns a JSON-serializable result, many
+    jobs may be running at once across workers. ``commit(job, result)``
+    then makes the result permanent, one job at a time and in queue order.
+    The lease is renewed while either is working; ``commit`` should call
+    ``job.renew()`` right before its final write and stop if it fails.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        kind: str,
+        run: Callable[[Job], Any],
+        commit: Callable[[Job, Any], None],
+        poll_interval: float = 1.0,
+    ):
+        # pylint: disable=too-many-arguments
+        self.queue = queue
+        self.kind = kind
+        self.run = run
+        self.commit = commit
+        self.poll_interval = poll_interval
+        self.name = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> "Worker":
+        """Start working in a background thread."""
+        self._thread = threading.Thread(
+            target=self.run_forever, name=f"worker-{self.kind}", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop after the job in hand, and wait for it."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def run_forever(self):
+        """Work until stopped, waiting for new jobs when there are none."""
+        while not self._stop.is_set():
+            try:
+                if not self.run_once():
+                    self._stop.wait(self.poll_interval)
+            # pylint: disable=broad-exception-caught
+            except Exception as e:
+                # the queue itself failed, e.g. the database is locked for too long
+                print(f"Job worker {self.name} error: {e}")
+                self._stop.wait(self.poll_interval)
+
+    def run_once(self) -> bool:
+        """Commit or run one job, False if there was nothing to do."""
+        # committing first keeps the results of finished jobs from piling up
+        job = self.queue.claim_in_order(self.name, self.kind)
+        if job is not None:
+            self._handle(job, "commit", lambda: self.commit(job, job.result))
+            return True
+        job = self.queue.claim(self.name, self.kind)
+        if job is not None:
+            self._handle(job, "run", lambda: self.run(job))
+            return True
+        return False
+
+    def _handle(self, job: Job, phase: str, work: Callable[[], Any]):
+        try:
+            with self._heartbeat(job), span("jobs", phase, kind=job.kind, job=job.id):
+                result = work()
+        except LeaseLost as e:
+            print(f"Job {job.key} was taken over by another worker: {e}")
+            count("jobs", "lost")
+            return
+        # pylint: disable=broad-exception-caught
+        except Exception as e:
+            print(f"Job {job.key} failed in {phase} (attempt {job.attempts}): {e}")
+            traceback.print_exc()
+            if self.queue.fail(job, f"{type(e).__name__}: {e}"):
+                count("jobs", "failed" if job.status == "failed" else "retried")
+            return
+
+        if phase == "run":
+            done = self.queue.finish(job, result)
+        else:
+            done = self.queue.complete(job)
+            if done:
+                count("jobs", "completed")
+        if not done:
+            print(f"Job {job.key} was taken over by another worker before it finished")
+            count("jobs", "lost")
+
+    @contextmanager
+    def _heartbeat(self, job: Job):
+        """Renew the lease on a job in the background while it is worked on."""
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.queue.lease_seconds / 3):
+                if not job.renew():
+                    return
+
+        thread = threading.Thread(target=renew, name=f"lease-{job.id}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,140 @@
+"""
+Incremental parsing of streamed JSON responses from the LLM.
+"""
+
+import json
+from typing import Callable, Iterable, Iterator, Optional
+
+# allowed before the root object, models like to wrap JSON in a ```json fence
+_PREAMBLE = set(" \t\r\n`json")
+
+
+class JSONArrayStream:
+    """
+    Pulls the objects of one array out of a JSON object while it is streamed in.
+
+    ``feed`` takes the next piece of text and returns the items of the array
+    under the root key ``key`` that were completed by it, so the caller can
+    use them before the rest of the response arrives. Text that cannot be
+    the expected object raises ValueError as soon as it is seen, and so
+    does an item that ``validate`` rejects.
+    """
+
+    def __init__(self, key: str, validate: Optional[Callable[[dict], bool]] = None):
+        self.key = key
+        self.validate = validate
+        self.items = 0
+        self.done = False
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        # root level key being read and the last one that was read
+        self._key_chars = None
+        self._last_key = None
+        self._in_array = False
+        # pieces of the item being read, None between items
+        self._item = None
+
+    def feed(self, text: str) -> list[dict]:
+        """Parse the next piece of the response and return the items it completed."""
+        completed = []
+        item_start = 0 if self._item is not None else None
+
+        for index, char in enumerate(text):
+            if self.done:
+                break
+
+            if not self._started:
+                if char == "{":
+                    self._started = True
+                    self._depth = 1
+                elif char not in _PREAMBLE:
+                    raise ValueError(f"Expected a JSON object, got {text[index:index + 40]!r}")
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_chars is not None:
+                        self._last_key = "".join(self._key_chars)
+                        self._key_chars = None
+                if self._key_chars is not None and self._in_string:
+                    self._key_chars.append(char)
+                continue
+
+            if (
+                self._in_array
+                and self._depth == 2
+                and self._item is None
+                and char not in " \t\r\n,{]"
+            ):
+                raise ValueError(f"Expected objects in '{self.key}'")
+
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    self._key_chars = []
+            elif char in "{[":
+                if self._in_array and self._depth == 2 and self._item is None:
+                    self._item = []
+                    item_start = index
+                elif self._depth == 1 and char == "[" and self._last_key == self.key:
+                    self._in_array = True
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth < 0:
+                    raise ValueError("Unbalanced JSON in response")
+                if self._item is not None and self._depth == 2:
+                    self._item.append(text[item_start:index + 1])
+                    completed.append(self._finish_item())
+                    item_start = None
+                elif self._in_array and self._depth == 1:
+                    self._in_array = False
+                    self.done = True
+                elif self._depth == 0:
+                    raise ValueError(f"No '{self.key}' array in response")
+
+        if self._item is not None and item_start is not None:
+            self._item.append(text[item_start:])
+        return completed
+
+    def close(self):
+        """Check that the array was read completely once the response has ended."""
+        if not self.done:
+            raise ValueError(f"Response ended before '{self.key}' was complete")
+
+    def _finish_item(self) -> dict:
+        item = json.loads("".join(self._item))
+        self._item = None
+        if self.validate and not self.validate(item):
+            raise ValueError(f"Invalid item in '{self.key}': {item}")
+        self.items += 1
+        return item
+
+
+def stream_items(
+    chunks: Iterable[str], key: str, validate: Optional[Callable[[dict], bool]] = None
+) -> Iterator[dict]:
+    """
+    Yield the objects of the array under ``key`` as the streamed response completes them.
+
+    The rest of the response is still read once the array has ended, but
+    ``chunks`` is closed as soon as the response turns out to be malformed,
+    which for a streamed completion stops the model from generating more.
+    """
+    parser = JSONArrayStream(key, validate)
+    try:
+        for chunk in chunks:
+            if not parser.done:
+                yield from parser.feed(chunk)
+        parser.close()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
@@ -1,93 +1,483 @@
 """
-Listens for audio input from the microphone and saves it to a WAV file.
+Listens for audio input from the microphone and saves speech segments to audio files.
 """
 
+import argparse
+import dataclasses
 import datetime
+import glob
+import io
+import json
+import math
 import os
-from collections import deque
+import queue
+import subprocess
+import threading
+import time
+import tracemalloc
 
 import numpy as np
-import sounddevice as sd
 import wavio as wv
+from scipy.signal import resample_poly
+
+from vad import VADConfig, VoiceActivityDetector
 
 SAMPLE_RATE = 44100
+# Whisper works on 16 kHz audio, so there is no point storing more than that.
+# Set to SAMPLE_RATE to keep the capture rate.
+OUTPUT_SAMPLE_RATE = 16000
+# rate of the float32 arrays handed straight to the transcriber
+WHISPER_SAMPLE_RATE = 16000
+# "wav" or "flac" (lossless, roughly half the size, needs soundfile)
+OUTPUT_FORMAT = "wav"
 CHUNK_DURATION = 0.5
 CHUNK_SIZE = int(SAMPLE_RATE * CHUNK_DURATION)
 SILENCE_THRESHOLD = 0.01
 SILENCE_DURATION = 2.0
+VAD_CONFIG = VADConfig(
+    start_threshold=SILENCE_THRESHOLD,
+    stop_threshold=SILENCE_THRESHOLD,
+    min_speech_duration=CHUNK_DURATION,
+    min_silence_duration=SILENCE_DURATION,
+)
+MAX_SEGMENT_DURATION = 120.0
+PRE_ROLL_DURATION = SILENCE_DURATION
+MAX_SEGMENT_SIZE = int(SAMPLE_RATE * MAX_SEGMENT_DURATION)
+PRE_ROLL_SIZE = int(SAMPLE_RATE * PRE_ROLL_DURATION)
+# extra audio kept in the ring so the writer thread can still copy a finished segment
+WRITER_HEADROOM_DURATION = 10.0
+WRITER_HEADROOM_SIZE = int(SAMPLE_RATE * WRITER_HEADROOM_DURATION)
+WRITER_QUEUE_SIZE = 8
+# what to do when the writer queue is full: "drop_oldest" or "drop_newest"
+QUEUE_FULL_POLICY = "drop_oldest"
 
-os.makedirs("./recordings", exist_ok=True)
+RECORDINGS_DIR = "./recordings"
 
 
-def rms(data):
-    """Calculate Root Mean Square (RMS) of audio data."""
-    return np.sqrt(np.mean(np.square(data)))
+class RingBuffer:
+    """
+    Fixed-size buffer that keeps the most recent audio samples.
 
-def stream_record():
+    Samples are addressed by their absolute index since the stream started.
+    Every sample is stored twice, ``capacity`` apart, so any window of up to
+    ``capacity`` samples is one contiguous slice and can be returned as a view.
     """
-    Streams audio from the microphone and saves it to a WAV file.
+
+    def __init__(self, capacity: int, dtype=np.float32):
+        self.capacity = capacity
+        self.total_written = 0
+        self._data = np.zeros(2 * capacity, dtype=dtype)
+
+    @property
+    def oldest(self) -> int:
+        """Absolute index of the oldest sample still held in the buffer."""
+        return max(0, self.total_written - self.capacity)
+
+    def write(self, samples: np.ndarray):
+        """Append samples, overwriting the oldest ones once the buffer is full."""
+        if len(samples) > self.capacity:
+            self.total_written += len(samples) - self.capacity
+            samples = samples[-self.capacity:]
+
+        pos = self.total_written % self.capacity
+        head = min(len(samples), self.capacity - pos)
+        tail = len(samples) - head
+
+        self._data[pos:pos + head] = samples[:head]
+        self._data[pos + self.capacity:pos + self.capacity + head] = samples[:head]
+        if tail:
+            self._data[:tail] = samples[head:]
+            self._data[self.capacity:self.capacity + tail] = samples[head:]
+
+        self.total_written += len(samples)
+
+    def view(self, start: int, end: int | None = None) -> np.ndarray:
+        """
+        Return samples ``[start, end)`` as a view into the buffer.
+
+        The view is only valid until another ``capacity - (end - start)``
+        samples have been written.
+        """
+        if end is None:
+            end = self.total_written
+        if start < self.oldest or end > self.total_written or start > end:
+            raise ValueError(
+                f"Samples [{start}, {end}) are not in the buffer "
+                f"(holding [{self.oldest}, {self.total_written}))"
+            )
+        offset = start % self.capacity
+        return self._data[offset:offset + (end - start)]
+
+
+class SegmentWriter:
     """
-    buffer = deque(maxlen=int(SILENCE_DURATION / CHUNK_DURATION))
-    full_buffer = []
-    is_recording = False
-    speech_start_index = 0
+    Writes finished segments to disk on a background thread.
 
-    print("Recording... Speak into the microphone.")
+    The audio callback only submits the sample range of a segment, which never
+    blocks. The writer copies the range out of the ring buffer later; if the
+    ring has already overwritten part of it the segment is counted as late
+    and discarded. When the queue is full, ``policy`` decides whether the
+    oldest pending segment or the new one is dropped.
 
-    def callback(indata, _frames, _time, status):
-        nonlocal is_recording, speech_start_index, full_buffer
+    With a ``handoff`` queue, segments are put on it as 16 kHz float32 arrays
+    together with their timestamp instead of being written to disk. Disk is
+    only used as a spill area while the handoff queue is full.
+    """
 
-        if status:
-            print(f"Error: {status}", flush=True)
+    def __init__(
+        self,
+        ring: RingBuffer,
+        max_pending: int = WRITER_QUEUE_SIZE,
+        policy: str = QUEUE_FULL_POLICY,
+        handoff: queue.Queue | None = None,
+    ):
+        if policy not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"Invalid queue full policy: {policy}")
+        self.ring = ring
+        self.policy = policy
+        self.handoff = handoff
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.stats = {"queued": 0, "written": 0, "handed_off": 0, "dropped": 0, "late": 0}
+        self._thread = threading.Thread(target=self._run, name="segment-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, start: int, end: int):
+        """Queue samples ``[start, end)`` of the ring for writing."""
+        item = (start, end, datetime.datetime.now())
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            if self.policy == "drop_newest":
+                return
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                return
+        self.stats["queued"] += 1
 
-        mono_data = indata.flatten()
-        full_buffer.append(mono_data)
-        buffer.append(mono_data)
+    def close(self):
+        """Write everything still queued and stop the thread."""
+        self.queue.put(None)
+        self._thread.join()
+        print(
+            "Segments handed off: {handed_off}, written: {written}, "
+            "dropped: {dropped}, late: {late}".format(**self.stats)
+        )
 
-        loudness = rms(mono_data)
-        has_speech = loudness > SILENCE_THRESHOLD
-        print("Loudness:", loudness, "Silence threshold:", SILENCE_THRESHOLD, "Has speech:", has_speech)
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            # pylint: disable=broad-except
+            except Exception as e:
+                print(f"Error writing segment: {e}")
+            finally:
+                self.queue.task_done()
 
-        if has_speech:
-            if not is_recording:
-                print("Speech detected. Starting recording...")
-                is_recording = True
-                speech_start_index = len(full_buffer) - len(buffer)
+    def _write(self, start: int, end: int, timestamp: datetime.datetime):
+        if start < self.ring.oldest:
+            self.stats["late"] += 1
+            print("Segment was overwritten before it could be written, skipping")
+            return
+        audio_data = self.ring.view(start, end).copy()
+        # the callback may have overwritten the start while we were copying
+        if start < self.ring.oldest:
+            self.stats["late"] += 1
+            print("Segment was overwritten while being written, skipping")
+            return
+
+        if self.handoff is not None:
+            audio_data = resample(audio_data, SAMPLE_RATE, WHISPER_SAMPLE_RATE)
+            try:
+                self.handoff.put_nowait((audio_data, timestamp))
+                self.stats["handed_off"] += 1
+                return
+            except queue.Full:
+                print("Transcriber is behind, spilling segment to disk")
+                save_recording(audio_data, timestamp, WHISPER_SAMPLE_RATE)
+                self.stats["written"] += 1
+                return
+
+        save_recording(audio_data, timestamp)
+        self.stats["written"] += 1
+
+
+class Segmenter:
+    """
+    Splits a stream of audio blocks into speech segments.
+
+    Blocks are written into a ring buffer and fed to the voice-activity
+    detector. Every finished segment is passed to ``on_segment`` as an
+    absolute sample range of the ring, ``[start, end)``.
+    """
+
+    def __init__(self, on_segment, vad_config: VADConfig = VAD_CONFIG):
+        self.on_segment = on_segment
+        self.vad = VoiceActivityDetector(vad_config, SAMPLE_RATE, CHUNK_SIZE)
+        self.ring = RingBuffer(MAX_SEGMENT_SIZE + PRE_ROLL_SIZE + WRITER_HEADROOM_SIZE)
+        self.is_recording = False
+        self.speech_start = 0
+
+    def process_block(self, block: np.ndarray) -> str | None:
+        """
+        Feed one block of mono float audio.
+
+        Returns "start", "stop" or "split" when a segment starts, ends or is
+        cut at the maximum length, and None otherwise.
+        """
+        ring = self.ring
+        ring.write(block)
+
+        event = self.vad.process(block)
+        if event == "start":
+            self.is_recording = True
+            onset = ring.total_written - self.vad.speech_blocks * len(block)
+            self.speech_start = max(ring.oldest, onset - PRE_ROLL_SIZE)
+        elif event == "stop" and self.is_recording:
+            self.on_segment(self.speech_start, ring.total_written)
+            self.is_recording = False
         else:
-            if (
-                is_recording
-                and len(buffer) == buffer.maxlen
-                and all(rms(chunk) <= SILENCE_THRESHOLD for chunk in buffer)
-            ):
-                print("Silence detected. Stopping recording.")
-                save_recording(full_buffer[speech_start_index:])
-                buffer.clear()
-                is_recording = False
+            event = None
+
+        if self.is_recording and ring.total_written - self.speech_start >= MAX_SEGMENT_SIZE + PRE_ROLL_SIZE:
+            self.on_segment(self.speech_start, ring.total_written)
+            self.speech_start = ring.total_written
+            event = "split"
+
+        return event
+
+    def flush(self):
+        """Emit the segment in progress, if any."""
+        if self.is_recording:
+            self.on_segment(max(self.speech_start, self.ring.oldest), self.ring.total_written)
+            self.is_recording = False
+
+
+def stream_record(handoff: queue.Queue | None = None, stop: threading.Event | None = None):
+    """
+    Streams audio from the microphone and saves speech segments to disk.
+
+    With ``handoff``, segments go to that queue instead (see SegmentWriter).
+    Recording runs until interrupted or until ``stop`` is set.
+    """
+    # PortAudio is only needed for live capture, replay works without a sound card
+    # pylint: disable=import-outside-toplevel
+    import sounddevice as sd
+
+    segmenter = Segmenter(None)
+    writer = SegmentWriter(segmenter.ring, handoff=handoff)
+    segmenter.on_segment = writer.submit
+
+    print("Recording... Speak into the microphone.")
+
+    def callback(indata, _frames, _time, status):
+        if status:
+            print(f"Error: {status}", flush=True)
+
+        event = segmenter.process_block(indata[:, 0])
+        if event == "start":
+            print("Speech detected. Starting recording...")
+        elif event == "stop":
+            print("Silence detected. Stopping recording.")
+        elif event == "split":
+            print("Maximum segment length reached. Starting a new recording...")
 
     with sd.InputStream(
         callback=callback, channels=1, samplerate=SAMPLE_RATE, blocksize=CHUNK_SIZE
     ):
         try:
-            sd.sleep(int(3600 * 10000))
+            if stop is not None:
+                stop.wait()
+            else:
+                sd.sleep(int(3600 * 10000))
         except KeyboardInterrupt:
             print("Recording interrupted by user.")
         finally:
-            if is_recording:
+            if segmenter.is_recording:
                 print("Finalizing recording...")
-                save_recording(full_buffer[speech_start_index:])
+                segmenter.flush()
+            writer.close()
             print("Recording stopped.")
 
 
-def save_recording(audio_data):
-    """Save the buffered audio to a WAV file."""
-    if not audio_data:
+def load_audio(path, target_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """Read an audio file (path or file object) as mono float32 at ``target_rate``."""
+    # pylint: disable=import-outside-toplevel
+    import soundfile as sf
+
+    audio_data, rate = sf.read(path, dtype="float32", always_2d=True)
+    return resample(audio_data.mean(axis=1), rate, target_rate)
+
+
+def decode_audio(data: bytes, target_rate: int = WHISPER_SAMPLE_RATE) -> np.ndarray:
+    """
+    Decode an uploaded audio file in memory as mono float32 at ``target_rate``.
+
+    Formats libsndfile understands (WAV, FLAC, OGG) are read directly; anything
+    else, such as the M4A or WebM phones record, is piped through ffmpeg.
+    """
+    # pylint: disable=import-outside-toplevel
+    import soundfile as sf
+
+    try:
+        return load_audio(io.BytesIO(data), target_rate)
+    except sf.LibsndfileError:
+        pass
+
+    try:
+        result = subprocess.run(
+            [
+                "ffmpeg", "-nostdin", "-loglevel", "error", "-i", "pipe:0",
+                "-f", "f32le", "-ac", "1", "-ar", str(target_rate), "pipe:1",
+            ],
+            input=data,
+            capture_output=True,
+            check=False,
+        )
+    except FileNotFoundError as e:
+        raise ValueError("Unsupported audio format and ffmpeg is not installed") from e
+    if result.returncode != 0:
+        raise ValueError(f"Could not decode audio: {result.stderr.decode(errors='replace').strip()}")
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+def _replay_sink(ring: RingBuffer, segment_lengths: list, write: bool):
+    def on_segment(start: int, end: int):
+        segment_lengths.append(end - start)
+        if write:
+            save_recording(ring.view(start, end).copy())
+
+    return on_segment
+
+
+def replay(paths: list[str], vad_config: VADConfig = VAD_CONFIG, write: bool = False) -> dict:
+    """
+    Run the segmenter over audio files as fast as possible and benchmark it.
+
+    Each file is segmented independently. With ``write`` the segments are
+    saved like live recordings, otherwise they are only counted.
+    """
+    tracemalloc.start()
+    block_times = []
+    segment_lengths = []
+    total_samples = 0
+    started = time.perf_counter()
+
+    for path in paths:
+        audio_data = load_audio(path)
+        total_samples += len(audio_data)
+        segmenter = Segmenter(None, vad_config)
+        segmenter.on_segment = _replay_sink(segmenter.ring, segment_lengths, write)
+        for offset in range(0, len(audio_data), CHUNK_SIZE):
+            block = audio_data[offset:offset + CHUNK_SIZE]
+            block_start = time.perf_counter()
+            segmenter.process_block(block)
+            block_times.append(time.perf_counter() - block_start)
+        segmenter.flush()
+
+    elapsed = time.perf_counter() - started
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    audio_minutes = total_samples / SAMPLE_RATE / 60
+    block_times = np.array(block_times) * 1000 if block_times else np.zeros(1)
+    return {
+        "files": len(paths),
+        "audio_minutes": audio_minutes,
+        "elapsed_seconds": elapsed,
+        "realtime_factor": audio_minutes * 60 / elapsed if elapsed else 0.0,
+        "segments": len(segment_lengths),
+        "segments_per_minute": len(segment_lengths) / audio_minutes if audio_minutes else 0.0,
+        "mean_segment_seconds": (
+            float(np.mean(segment_lengths)) / SAMPLE_RATE if segment_lengths else 0.0
+        ),
+        "block_ms_mean": float(np.mean(block_times)),
+        "block_ms_p95": float(np.percentile(block_times, 95)),
+        "block_ms_max": float(np.max(block_times)),
+        "peak_memory_mb": peak_memory / 1024 / 1024,
+    }
+
+
+def resample(audio_data: np.ndarray, orig_rate: int, target_rate: int) -> np.ndarray:
+    """Resample audio with a polyphase filter."""
+    if orig_rate == target_rate:
+        return audio_data
+    divisor = math.gcd(orig_rate, target_rate)
+    resampled = resample_poly(audio_data, target_rate // divisor, orig_rate // divisor)
+    return resampled.astype(np.float32, copy=False)
+
+
+def save_recording(
+    audio_data: np.ndarray, ts: datetime.datetime | None = None, rate: int = SAMPLE_RATE
+):
+    """Save audio sampled at ``rate`` to a WAV or FLAC file at OUTPUT_SAMPLE_RATE."""
+    if not audio_data.size:
         return
-    audio_data = np.concatenate(audio_data)
-    ts = datetime.datetime.now()
-    filename = ts.strftime("%Y-%m-%d %H-%M-%S") + ".wav"
-    file_path = os.path.join("./recordings", filename)
-    wv.write(file_path, audio_data, SAMPLE_RATE, sampwidth=2)
+    ts = ts or datetime.datetime.now()
+    audio_data = np.clip(resample(audio_data, rate, OUTPUT_SAMPLE_RATE), -1.0, 1.0)
+
+    filename = ts.strftime("%Y-%m-%d %H-%M-%S-%f") + "." + OUTPUT_FORMAT
+    os.makedirs(RECORDINGS_DIR, exist_ok=True)
+    file_path = os.path.join(RECORDINGS_DIR, filename)
+    # write under a temporary name so the transcriber never sees a partial file
+    partial_path = file_path + ".part"
+    if OUTPUT_FORMAT == "flac":
+        # pylint: disable=import-outside-toplevel
+        import soundfile as sf
+
+        sf.write(partial_path, audio_data, OUTPUT_SAMPLE_RATE, format="FLAC", subtype="PCM_16")
+    else:
+        wv.write(partial_path, audio_data, OUTPUT_SAMPLE_RATE, sampwidth=2)
+    os.replace(partial_path, file_path)
     print(f"Saved recording to {file_path}")
 
 
-stream_record()
+def main():
+    """Record from the microphone, or replay audio files with --replay."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--replay", nargs="+", metavar="PATH",
+        help="segment WAV files or directories of WAV files instead of the microphone",
+    )
+    parser.add_argument("--write", action="store_true", help="save replayed segments")
+    parser.add_argument("--start-threshold", type=float, default=VAD_CONFIG.start_threshold)
+    parser.add_argument("--stop-threshold", type=float, default=VAD_CONFIG.stop_threshold)
+    parser.add_argument("--min-speech", type=float, default=VAD_CONFIG.min_speech_duration)
+    parser.add_argument("--min-silence", type=float, default=VAD_CONFIG.min_silence_duration)
+    parser.add_argument("--spectral", action="store_true", help="use speech-band energy")
+    args = parser.parse_args()
+
+    if not args.replay:
+        stream_record()
+        return
+
+    paths = []
+    for path in args.replay:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob.glob(os.path.join(path, "*.wav"))))
+        else:
+            paths.append(path)
+
+    vad_config = dataclasses.replace(
+        VAD_CONFIG,
+        start_threshold=args.start_threshold,
+        stop_threshold=args.stop_threshold,
+        min_speech_duration=args.min_speech,
+        min_silence_duration=args.min_silence,
+        spectral=args.spectral,
+    )
+    results = replay(paths, vad_config, write=args.write)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,40 @@
 Generates text using the Groq API.
 """
 
+import asyncio
 import os
+import threading
+import time
 from dataclasses import dataclass
-from typing import Optional
+from typing import Iterator, Optional
 
+import httpx
 from dotenv import load_dotenv
-from groq import Groq
+from groq import (
+    APIConnectionError,
+    AsyncGroq,
+    Groq,
+    InternalServerError,
+    RateLimitError,
+)
+
+from llm_cache import LLMCache, cache_key
+from rate_limit import RateLimiter, backoff_delay
+from tracing import record_llm_cache_hit, record_llm_call
 
 load_dotenv()
 
 
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a prompt, about four characters per token."""
+    return (len(text) + 3) // 4
+
+
+def _env_limit(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
 @dataclass
 class GroqModelConfig:
     """
@@ -24,19 +48,164 @@ class GroqModelConfig:
     temperature: float = 0.6
     max_tokens: Optional[int] = 4096
     top_p: float = 0.95
+    # prompts estimated above this are rejected before they are sent
+    max_prompt_tokens: Optional[int] = 12000
+    # another Groq compatible endpoint, e.g. the local mock_groq server
+    base_url: Optional[str] = None
+    # set to a SQLite path to cache responses, e.g. while replaying batches in development
+    cache_path: Optional[str] = None
+    cache_ttl: Optional[float] = 7 * 24 * 3600
+    cache_max_entries: int = 10000
+    # account quotas, both clients hold requests back to stay within them when set;
+    # off by default, rate limited requests are retried instead
+    requests_per_minute: Optional[int] = _env_limit("GROQ_REQUESTS_PER_MINUTE")
+    tokens_per_minute: Optional[int] = _env_limit("GROQ_TOKENS_PER_MINUTE")
+    # retries of rate limited, dropped or failed requests, with exponential backoff
+    max_retries: int = 5
+    backoff_base: float = 1.0
+    backoff_max: float = 60.0
+    # connections kept open to the API by AsyncGroqClient
+    max_connections: int = 8
+
+
+@dataclass
+class _Request:
+    """A prompt that is within the budget, with its cache entry and API arguments."""
+    estimate: int
+    key: Optional[str]
+    cached: Optional[str]
+    kwargs: dict
+
+
+# errors worth sending a request again for
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+
+class _GroqRequests:
+    """
+    The prompt budget, response cache, retries and usage accounting of both clients.
+    """
+    config: GroqModelConfig
+    cache: Optional[LLMCache]
+    limiter: RateLimiter
+    usage: dict
+    _usage_lock: threading.Lock
+
+    def _prepare(self, prompt: str, json_mode: bool, timeout: Optional[float]) -> _Request:
+        """Check the prompt against the budget and the cache, and build the request."""
+        estimate = estimate_tokens(prompt)
+        if self.config.max_prompt_tokens and estimate > self.config.max_prompt_tokens:
+            raise ValueError(
+                f"Prompt of about {estimate} tokens exceeds "
+                f"the limit of {self.config.max_prompt_tokens}"
+            )
 
+        key = None
+        cached = None
+        if self.cache:
+            key = cache_key(
+                prompt,
+                model=self.config.model,
+                temperature=self.config.temperature,
+                top_p=self.config.top_p,
+                max_tokens=self.config.max_tokens,
+                json_mode=json_mode,
+            )
+            cached = self.cache.get(key)
+            if cached is not None:
+                record_llm_cache_hit(self.config.model)
 
-class GroqClient:
+        kwargs = {
+            "messages": [{"role": "user", "content": prompt}],
+            "model": self.config.model,
+            "temperature": self.config.temperature,
+            "max_tokens": self.config.max_tokens,
+            "top_p": self.config.top_p,
+        }
+        if json_mode:
+            kwargs["response_format"] = {"type": "json_object"}
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        return _Request(estimate, key, cached, kwargs)
+
+    def _retry_delay(
+        self, attempt: int, error: Exception, max_retries: Optional[int] = None
+    ) -> Optional[float]:
+        """
+        How long to wait before retrying a request that failed with a retryable
+        error, or None once it has been retried ``max_retries`` times, by default
+        the config's. The delay backs off exponentially with jitter and honours
+        the retry-after header of a 429.
+        """
+        if attempt >= (self.config.max_retries if max_retries is None else max_retries):
+            return None
+        delay = backoff_delay(attempt, self.config.backoff_base, self.config.backoff_max)
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            # the quota is shared, so everyone waits rather than only this request
+            self.limiter.pause(retry_after)
+            delay = max(delay, retry_after)
+        print(f"Groq request failed ({type(error).__name__}), retrying in {delay:.1f}s")
+        with self._usage_lock:
+            self.usage["retries"] += 1
+        return delay
+
+    def _finish(self, request: _Request, usage, started: float, response: Optional[str]):
+        """Account for a finished call and cache its response, if it has one."""
+        with self._usage_lock:
+            self.usage["calls"] += 1
+            if usage:
+                self.usage["prompt_tokens"] += usage.prompt_tokens
+                self.usage["completion_tokens"] += usage.completion_tokens
+        if usage:
+            self.limiter.settle(request.estimate, usage.total_tokens)
+        record_llm_call(
+            self.config.model,
+            time.perf_counter() - started,
+            usage.prompt_tokens if usage else 0,
+            usage.completion_tokens if usage else 0,
+        )
+        if self.cache and response:
+            self.cache.put(request.key, response)
+
+
+class GroqClient(_GroqRequests):
     """
     Generates text using the Groq API.
+
+    Rate limited and failed requests are retried with exponential backoff and
+    jitter, honouring the retry-after header of a 429.
     """
     def __init__(self, config: GroqModelConfig):
         self.config = config
-        self.client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+        self.client = Groq(
+            api_key=os.getenv("GROQ_API_KEY"),
+            base_url=config.base_url,
+            # retries are done here so that they go through the rate limiter
+            max_retries=0,
+        )
+        self.usage = {"calls": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self._usage_lock = threading.Lock()
+        # shared by every thread using this client
+        self.limiter = RateLimiter(config.requests_per_minute, config.tokens_per_minute)
+        self.cache = (
+            LLMCache(config.cache_path, config.cache_ttl, config.cache_max_entries)
+            if config.cache_path
+            else None
+        )
 
-    def generate_text(self, text: str) -> str:
+    def generate_text(
+        self,
+        text: str,
+        json_mode: bool = False,
+        timeout: Optional[float] = None,
+        max_retries: Optional[int] = None,
+    ) -> str:
         """
         Generates text using the Groq model.
+        With json_mode the model is constrained to return a single JSON object.
+        The timeout applies to each attempt, so a call with a deadline sets
+        max_retries too. The client is thread-safe, so calls may run concurrently.
         """
 #         prompt = f"""
 # You are an expert text processor. The following text contains multiple conversations on different topics.
@@ -63,18 +232,153 @@ class GroqClient:
 # }}
 # </json>
 # """
-        prompt = text
-
-        completion = self.client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model=self.config.model,
-            temperature=self.config.temperature,
-            max_tokens=self.config.max_tokens,
-            top_p=self.config.top_p,
-            # response_format={"type": "json_object"}
+        request = self._prepare(text, json_mode, timeout)
+        if request.cached is not None:
+            return request.cached
+
+        completion, started = self._create(request, max_retries)
+        response = completion.choices[0].message.content
+        self._finish(request, completion.usage, started, response)
+        return response
+
+    def stream_text(
+        self, text: str, json_mode: bool = False, timeout: Optional[float] = None
+    ) -> Iterator[str]:
+        """
+        Generates text using the Groq model and yields it piece by piece as it arrives.
+        Closing the iterator early closes the connection, so the rest of the
+        completion is not generated.
+        """
+        request = self._prepare(text, json_mode, timeout)
+        if request.cached is not None:
+            yield request.cached
+            return
+
+        # only opening the stream is retried, a stream cut off halfway is not
+        stream, started = self._create(request, stream=True)
+
+        pieces = []
+        usage = None
+        complete = False
+        try:
+            for chunk in stream:
+                # Groq reports the usage in the last chunk
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq is not None and getattr(x_groq, "usage", None):
+                    usage = x_groq.usage
+                if not chunk.choices:
+                    continue
+                piece = chunk.choices[0].delta.content
+                if piece:
+                    pieces.append(piece)
+                    yield piece
+            complete = True
+        finally:
+            stream.close()
+            # only a response that was read to the end is cached
+            self._finish(request, usage, started, "".join(pieces) if complete else None)
+
+    def _create(self, request: _Request, max_retries: Optional[int] = None, **extra):
+        """Send a request, waiting for quota and retrying as needed."""
+        attempt = 0
+        while True:
+            self.limiter.wait(request.estimate)
+            started = time.perf_counter()
+            try:
+                return self.client.chat.completions.create(**extra, **request.kwargs), started
+            except RETRYABLE_ERRORS as e:
+                delay = self._retry_delay(attempt, e, max_retries)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+
+
+class AsyncGroqClient(_GroqRequests):
+    """
+    Sends prompts to the Groq API concurrently without exceeding the rate limits.
+
+    All requests share one connection pool and one RateLimiter. Rate limited
+    and failed requests are retried with exponential backoff and jitter,
+    honouring the retry-after header of a 429.
+    """
+    def __init__(self, config: GroqModelConfig):
+        self.config = config
+        self.client = AsyncGroq(
+            api_key=os.getenv("GROQ_API_KEY"),
+            base_url=config.base_url,
+            # retries are done here so that they go through the rate limiter
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=config.max_connections,
+                    max_keepalive_connections=config.max_connections,
+                )
+            ),
         )
+        self.limiter = RateLimiter(config.requests_per_minute, config.tokens_per_minute)
+        self.usage = {"calls": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self._usage_lock = threading.Lock()
+        self.cache = (
+            LLMCache(config.cache_path, config.cache_ttl, config.cache_max_entries)
+            if config.cache_path
+            else None
+        )
+
+    async def generate_text(
+        self, text: str, json_mode: bool = False, timeout: Optional[float] = None
+    ) -> str:
+        """
+        Generates text using the Groq model, waiting for quota and retrying as needed.
+        """
+        request = self._prepare(text, json_mode, timeout)
+        if request.cached is not None:
+            return request.cached
+
+        attempt = 0
+        while True:
+            await self.limiter.acquire(request.estimate)
+            started = time.perf_counter()
+            try:
+                completion = await self.client.chat.completions.create(**request.kwargs)
+                break
+            except RETRYABLE_ERRORS as e:
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+
+        response = completion.choices[0].message.content
+        self._finish(request, completion.usage, started, response)
+        return response
+
+    async def generate_many(
+        self, texts: list[str], json_mode: bool = False, timeout: Optional[float] = None
+    ) -> list:
+        """
+        Generates text for every prompt as fast as the quota allows.
+        Results are in the order of the prompts; a prompt that failed after
+        all retries has its exception in its place.
+        """
+        return await asyncio.gather(
+            *(self.generate_text(text, json_mode, timeout) for text in texts),
+            return_exceptions=True,
+        )
+
+    async def close(self):
+        """Close the connection pool."""
+        await self.client.close()
+
 
-        return completion.choices[0].message.content
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+"""
+In-memory stand-in for the Firebase database, for running the pipeline offline.
+"""
+
+import copy
+import threading
+
+from database import BaseDatabase
+
+
+class _RootRef:
+    """
+    The part of a Firebase reference that WriteBatch uses.
+    """
+
+    def __init__(self, database: "InMemoryDatabase"):
+        self.database = database
+
+    def update(self, updates: dict):
+        """Apply a multi-location update."""
+        self.database.apply(updates)
+
+
+class InMemoryDatabase(BaseDatabase):
+    """
+    Same methods as Database, with the data kept in nested dicts.
+
+    Reads return copies, like a Firebase get, and every read and write is
+    counted in ``stats``.
+    """
+
+    def __init__(self, data: dict | None = None):
+        self.data = copy.deepcopy(data) if data else {}
+        self.root_ref = _RootRef(self)
+        self.stats = {"reads": 0, "writes": 0}
+        self._lock = threading.Lock()
+
+    def apply(self, updates: dict):
+        """Write every ``{path: value}`` pair at once, None deletes the path."""
+        with self._lock:
+            self.stats["writes"] += 1
+            for path, value in updates.items():
+                *parents, name = [part for part in path.split("/") if part]
+                node = self.data
+                for part in parents:
+                    node = node.setdefault(part, {})
+                if value is None:
+                    node.pop(name, None)
+                else:
+                    node[name] = copy.deepcopy(value)
+
+    def _read(self, path: str):
+        with self._lock:
+            self.stats["reads"] += 1
+            node = self.data
+            for part in [part for part in path.split("/") if part]:
+                if not isinstance(node, dict) or part not in node:
+                    return None
+                node = node[part]
+            return copy.deepcopy(node) if node != {} else None
+
+    def upload_image(self, image_url: str) -> str:
+        """Keep the generated image where it is."""
+        return image_url
+
+    def get_transcriptions(
+        self, start_time: str | None = None, end_time: str | None = None
+    ):
+        """Get the transcriptions, optionally between two timestamps."""
+        transcriptions = self._read("transcriptions") or {}
+        return {
+            key: transcription
+            for key, transcription in sorted(
+                transcriptions.items(), key=lambda item: item[1].get("timestamp", "")
+            )
+            if (start_time is None or transcription.get("timestamp", "") >= start_time)
+            and (end_time is None or transcription.get("timestamp", "") <= end_time)
+        } or None
+
+    def get_transcriptions_after(self, key: str | None, limit: int):
+        """Get up to ``limit`` transcriptions with keys after ``key``, oldest first."""
+        transcriptions = self._read("transcriptions") or {}
+        keys = sorted(k for k in transcriptions if key is None or k > key)[:limit]
+        return {k: transcriptions[k] for k in keys}
+
+    def get_transcriptions_between(self, after: str | None, last: str):
+        """Get the transcriptions with keys after ``after`` up to ``last``, oldest first."""
+        transcriptions = self._read("transcriptions") or {}
+        keys = sorted(k for k in transcriptions if (after is None or k > after) and k <= last)
+        return {k: transcriptions[k] for k in keys}
+
+    def get_transcriptions_until(self, key: str, limit: int):
+        """Get up to ``limit`` of the oldest transcriptions with keys up to ``key``."""
+        transcriptions = self._read("transcriptions") or {}
+        keys = sorted(k for k in transcriptions if k <= key)[:limit]
+        return {k: transcriptions[k] for k in keys}
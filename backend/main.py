@@ -2,24 +2,63 @@
 Main file for the application.
 """
 
+import asyncio
+import os
+from concurrent.futures import BrokenExecutor
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, File, HTTPException, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from database import Database
-from memory_manager import MemoryManager
+from job_queue import JobQueue, Worker
+from memory_manager import BATCH_JOB, QUEUE_PATH, MemoryManager
 from dalle import DalleImage
 from datetime import datetime
+import listener
+from tracing import count, span
+from transcription_cache import DEFAULT_PATH, TranscriptionCache, audio_key
+from whisper_backends import TranscriberConfig, TranscriptionPool
 
 load_dotenv(override=True)
 
 manager = MemoryManager()
 scheduler = AsyncIOScheduler()
+# batches of transcriptions waiting to become memories, more workers can be
+# started in other processes with memory_worker.py
+job_queue = JobQueue(QUEUE_PATH)
+# batches generated side by side, so a backlog is caught up about this many
+# times faster; the workers share the manager's client and its rate limiter
+MEMORY_QUEUE_WORKERS = int(os.getenv("MEMORY_QUEUE_WORKERS", "4"))
+# done jobs are kept this long for inspection
+MEMORY_QUEUE_RETENTION = 7 * 24 * 3600
+memory_workers: list[Worker] = []
 db = Database()
 dalle = DalleImage()
 
+transcription_config = TranscriberConfig(
+    backend=os.getenv("TRANSCRIBE_BACKEND", TranscriberConfig.backend),
+    model=os.getenv("TRANSCRIBE_MODEL"),
+    workers=int(os.getenv("TRANSCRIBE_WORKERS", str(TranscriberConfig.workers))),
+)
+# uploads waiting for or being transcribed before new ones are turned away with 429
+TRANSCRIBE_MAX_PENDING = int(os.getenv("TRANSCRIBE_MAX_PENDING", "8"))
+TRANSCRIBE_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+# room for the multipart boundaries and headers around the file in an upload
+TRANSCRIBE_FORM_OVERHEAD_BYTES = 64 * 1024
+transcription_pool: TranscriptionPool | None = None
+transcription_cache: TranscriptionCache | None = None
+transcriptions_pending = 0
+
 def process_memory_images():
     """Process memories that don't have images yet"""
+    with span("images", "run"):
+        _process_memory_images()
+
+def _process_memory_images():
+    """Generate, upload and attach images for memories without one"""
     # print("\n=== Starting Image Generation Process ===")
     memories = db.get_memories()
     if not memories:
@@ -40,50 +79,109 @@ def process_memory_images():
             # print(f"DALL-E prompt: {memory_data.get('dalle_prompt')}")
 
             # generate dalle
-            dalle_url, error = dalle.generate_memory_image(memory_data)
+            with span("images", "generate", memory=memory_id):
+                dalle_url, error = dalle.generate_memory_image(memory_data)
             if error:
                 print(f"Error generating DALL-E image for memory {memory_id}: {error}")
+                count("images", "failed")
                 continue
 
             if not dalle_url:
                 print(f"No DALL-E URL generated for memory {memory_id}")
+                count("images", "failed")
                 continue
 
             print(f"Generated DALL-E image: {dalle_url}")
 
             # upload to uploadthing
             # print("Uploading to Uploadthing...")
-            upload_url = db.upload_image(dalle_url)
+            with span("images", "upload", memory=memory_id):
+                upload_url = db.upload_image(dalle_url)
             if not upload_url:
                 print(f"Failed to upload image for memory {memory_id}")
+                count("images", "failed")
                 continue
 
             # update memory field
             memory_data['image_url'] = upload_url
-            db.update_memory(memory_id, memory_data)
+            with span("images", "update", memory=memory_id):
+                db.update_memory(memory_id, memory_data)
+            count("images", "generated")
             # print(f"Successfully added image to memory {memory_id}")
             # print(f"Image URL: {upload_url}")
         # pylint: disable=broad-except
         except Exception as e:
             print(f"Error processing memory {memory_id}: {str(e)}")
+            count("images", "failed")
             continue
 
     # print("=== Image Generation Process Complete ===\n")
 
+def queue_transcriptions():
+    """Queue the new transcriptions as batch jobs for the memory workers"""
+    try:
+        manager.enqueue_batches(job_queue)
+        job_queue.purge(MEMORY_QUEUE_RETENTION)
+    # pylint: disable=broad-except
+    except Exception as e:
+        print(f"Error queueing transcriptions: {e}")
+
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
     """Lifecycle manager for the FastAPI app"""
-    # run once to startup, remove later
-    manager.process_transcriptions()
-    scheduler.add_job(manager.process_transcriptions, "interval", seconds=60, max_instances=1)
+    # queue new transcriptions every minute, the workers pick them up from there
+    queue_transcriptions()
+    scheduler.add_job(queue_transcriptions, "interval", seconds=60, max_instances=1)
+    # pylint: disable=global-statement
+    global memory_workers
+    memory_workers = [
+        Worker(job_queue, BATCH_JOB, manager.run_batch_job, manager.commit_batch_job).start()
+        for _ in range(MEMORY_QUEUE_WORKERS)
+    ]
     # schedule image generation (every 5 seconds)
     scheduler.add_job(process_memory_images, "interval", seconds=5, max_instances=1)
     scheduler.start()
+    global transcription_pool, transcription_cache
+    try:
+        transcription_pool = TranscriptionPool(transcription_config)
+        transcription_cache = TranscriptionCache(
+            os.getenv("TRANSCRIPTION_CACHE_PATH", DEFAULT_PATH)
+        )
+    # pylint: disable=broad-except
+    except Exception as e:
+        print(f"Transcription endpoint disabled: {e}")
+        if transcription_pool:
+            transcription_pool.shutdown()
+        transcription_pool = None
     yield
     scheduler.shutdown()
+    for worker in memory_workers:
+        worker.stop()
+    job_queue.close()
+    if transcription_pool:
+        transcription_pool.shutdown()
+    if transcription_cache:
+        transcription_cache.close()
 
 app = FastAPI(lifespan=lifespan)
 
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """
+    Turn away oversized uploads by their Content-Length, before the form is
+    parsed; FastAPI reads the whole body into a spooled file before the
+    endpoint runs, so the endpoint itself cannot stop a large upload.
+    """
+    if request.url.path == "/transcribe" and request.method == "POST":
+        length = request.headers.get("content-length")
+        if length is None:
+            return JSONResponse({"detail": "Content-Length is required"}, status_code=411)
+        if not length.isdigit() or (
+            int(length) > TRANSCRIBE_MAX_UPLOAD_BYTES + TRANSCRIBE_FORM_OVERHEAD_BYTES
+        ):
+            return JSONResponse({"detail": "Audio file is too large"}, status_code=413)
+    return await call_next(request)
+
 @app.get("/")
 def home():
     """Home page"""
@@ -111,12 +209,81 @@ def get_memory(memory_id: str):
     """Get a specific memory"""
     return db.get_memory(memory_id)
 
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics of the memory, image and transcription pipelines"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/jobs")
+def get_jobs():
+    """Number of memory batch jobs in each status"""
+    return job_queue.counts(BATCH_JOB)
+
 @app.post("/generate-images")
 def generate_images():
     """Manually trigger image generation for memories"""
     process_memory_images()
     return {"message": "Image generation process completed"}
 
+def store_transcription(key: str, text: str):
+    """Save a transcription and flag its cache entry as saved"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
+    db.create_transcription({"text": text, "timestamp": timestamp})
+    transcription_cache.mark_stored(key)
+
+@app.post("/transcribe")
+async def transcribe(file: UploadFile = File(...), store: bool = True):
+    """Transcribe an uploaded audio segment and optionally save it as a transcription"""
+    # pylint: disable=global-statement
+    global transcriptions_pending
+    if transcription_pool is None:
+        raise HTTPException(status_code=503, detail="Transcription is not available")
+    if transcriptions_pending >= TRANSCRIBE_MAX_PENDING:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many transcriptions in progress",
+            headers={"Retry-After": "5"},
+        )
+
+    transcriptions_pending += 1
+    try:
+        # the body was checked with room for the form around the file, check the file itself
+        data = await file.read(TRANSCRIBE_MAX_UPLOAD_BYTES + 1)
+        if len(data) > TRANSCRIBE_MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Audio file is too large")
+
+        try:
+            audio = await run_in_threadpool(listener.decode_audio, data)
+        except ValueError as e:
+            raise HTTPException(status_code=415, detail=str(e)) from e
+
+        key = audio_key(audio, transcription_pool.model_id)
+        cached = await run_in_threadpool(transcription_cache.get, key)
+        if cached is not None:
+            count("transcriber", "cache_hits")
+            text, stored = cached
+            if store and text and not stored:
+                # transcribed before but not saved, e.g. the first upload had store=False
+                await run_in_threadpool(store_transcription, key, text)
+            return {"text": text, "cached": True}
+
+        try:
+            with span("transcriber", "transcribe"):
+                result = await asyncio.wrap_future(transcription_pool.submit(audio))
+        except BrokenExecutor as e:
+            raise HTTPException(
+                status_code=503, detail="Transcription backend is unavailable"
+            ) from e
+
+        text = result["text"].strip()
+        count("transcriber", "segments")
+        await run_in_threadpool(transcription_cache.put, key, transcription_pool.model_id, text)
+        if store and text:
+            await run_in_threadpool(store_transcription, key, text)
+        return {"text": text, "cached": False}
+    finally:
+        transcriptions_pending -= 1
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
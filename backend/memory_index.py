@@ -0,0 +1,164 @@
+"""
+Nearest-neighbour index of memory embeddings, for matching new topics to existing memories.
+"""
+
+import hashlib
+import re
+from typing import Optional
+
+import numpy as np
+
+_WORD = re.compile(r"[\w']+")
+
+
+class HashingEmbedder:
+    """
+    Embeds text by hashing its words and word pairs into a fixed-size vector.
+
+    Needs nothing beyond NumPy and only matches on shared words, so it is
+    the fallback when sentence-transformers is not installed.
+    """
+    name = "hashing"
+    # no default: unrelated topics that share filler words ("should talk about")
+    # score above related ones, so new topics are only routed to existing
+    # memories when MEMORY_MATCH_THRESHOLD is set
+    default_threshold = None
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """Return one unit-length row per text."""
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = [word.lower() for word in _WORD.findall(text)]
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                vectors[row, value % self.dim] += 1.0 if value >> 63 else -1.0
+        return _normalize(vectors)
+
+
+class SentenceTransformerEmbedder:
+    """
+    Embeds text with a small sentence-transformers model on the CPU.
+    """
+    name = "sentence-transformers"
+    default_threshold = 0.7
+
+    def __init__(self, model: str = "all-MiniLM-L6-v2"):
+        # pylint: disable=import-outside-toplevel
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """Return one unit-length row per text."""
+        vectors = self.model.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+def create_embedder(model: Optional[str] = None):
+    """
+    Load a sentence-transformers model, or fall back to the hashing embedder
+    when it is not installed or the model cannot be loaded.
+    """
+    try:
+        return SentenceTransformerEmbedder(model) if model else SentenceTransformerEmbedder()
+    except ImportError:
+        print("sentence-transformers is not installed, matching memories by hashed words")
+        return HashingEmbedder()
+    # pylint: disable=broad-exception-caught
+    except Exception as e:
+        # e.g. the model could not be downloaded, which should not stop the server
+        print(f"Could not load embedding model ({e}), matching memories by hashed words")
+        return HashingEmbedder()
+
+
+def memory_text(memory: dict) -> str:
+    """The part of a memory that says what it is about."""
+    return " ".join(
+        str(memory[field]) for field in ("topic", "summary") if memory.get(field)
+    )
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class MemoryIndex:
+    """
+    In-memory matrix of memory embeddings searched by cosine similarity.
+
+    Rows are appended as memories are created and removed when memories are
+    deleted, so the index only has to be built from the database once.
+    """
+
+    def __init__(self, embedder, threshold: Optional[float] = None):
+        self.embedder = embedder
+        self.threshold = embedder.default_threshold if threshold is None else threshold
+        self.ids: list[str] = []
+        self._rows: dict[str, int] = {}
+        self._vectors = np.zeros((0, embedder.dim), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, memory_id: str) -> bool:
+        return memory_id in self._rows
+
+    def rebuild(self, memories: dict):
+        """Replace the index with the given {memory_id: memory}."""
+        entries = [(key, memory_text(memory)) for key, memory in memories.items()]
+        entries = [(key, text) for key, text in entries if text]
+        self.ids = [key for key, _ in entries]
+        self._rows = {key: row for row, key in enumerate(self.ids)}
+        self._vectors = (
+            self.embedder.embed([text for _, text in entries])
+            if entries
+            else np.zeros((0, self.embedder.dim), dtype=np.float32)
+        )
+
+    def add(self, memory_id: str, memory: dict):
+        """Index a new memory, or re-index one whose topic or summary changed."""
+        text = memory_text(memory)
+        if not text:
+            return
+        vector = self.embedder.embed([text])[0]
+        if memory_id in self._rows:
+            self._vectors[self._rows[memory_id]] = vector
+            return
+        self._rows[memory_id] = len(self.ids)
+        self.ids.append(memory_id)
+        self._vectors = np.vstack([self._vectors, vector])
+
+    def remove(self, memory_id: str):
+        """Drop a memory from the index."""
+        row = self._rows.pop(memory_id, None)
+        if row is None:
+            return
+        # move the last row into the gap instead of shifting the rest
+        last = len(self.ids) - 1
+        if row != last:
+            moved = self.ids[last]
+            self.ids[row] = moved
+            self._rows[moved] = row
+            self._vectors[row] = self._vectors[last]
+        self.ids.pop()
+        self._vectors = self._vectors[:last]
+
+    def nearest(self, memory: dict) -> Optional[tuple[str, float]]:
+        """
+        Return ``(memory_id, similarity)`` of the closest indexed memory, or
+        None if nothing is at least ``threshold`` similar or there is no threshold.
+        """
+        text = memory_text(memory)
+        if not text or not self.ids or self.threshold is None:
+            return None
+        scores = self._vectors @ self.embedder.embed([text])[0]
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        return self.ids[best], float(scores[best])
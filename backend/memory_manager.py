@@ -2,21 +2,277 @@
 Advanced memory management system with multi-step processing pipeline.
 """
 
+import difflib
 import json
-from datetime import datetime, timedelta
+import os
+import re
+import time
+from datetime import datetime
 from typing import Dict, List
-import traceback
-
-from llm import GroqClient, GroqModelConfig
-from database import Database
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from contextvars import copy_context
+
+from job_queue import Job, JobQueue, LeaseLost
+from json_stream import stream_items
+from llm import GroqClient, GroqModelConfig, estimate_tokens
+from memory_index import MemoryIndex, create_embedder
+from tracing import count, span
+from database import Database, WriteBatch
+
+# "staged" (analyze, plan, execute), "fast" (one call for the whole batch)
+# or "auto" (fast for small batches, staged for large ones or when fast fails)
+#
+# bench_pipeline.py against the mock server (0.2 s per call, 1000 tokens/s),
+# one worker, streamed:
+#   transcriptions  mode    seconds  calls  prompt tokens  completion tokens
+#   20              fast    1.45     1      656            869
+#   20              staged  2.23     7      3512           1603
+#   50              fast    2.61     1      1069           2157
+#   50              staged  3.31     13     7752           3977
+#   300             fast    15.46    6      6286           12827
+#   300             staged  19.51    78     47137          23572
+PIPELINE_MODE = os.getenv("MEMORY_PIPELINE_MODE", "auto")
+FAST_PATH_MAX_TRANSCRIPTIONS = 20
+FAST_PATH_MAX_CHARS = 8000
+# transcriptions per queued batch, a backlog is queued as several batches
+BATCH_SIZE = int(os.getenv("MEMORY_BATCH_SIZE", "50"))
+# transcription text per queued batch, and the silence after which a new batch
+# starts, so a backlog is queued as time-contiguous batches of similar size
+BATCH_MAX_TOKENS = 2000
+BATCH_GAP_SECONDS = 300
+# where the key of the last processed transcription is kept, under "cursors/"
+CURSOR_NAME = "memory_manager"
+# kind of the queued jobs that each process one batch
+BATCH_JOB = "memory_batch"
+# the job queue shared by the API server and memory_worker.py, next to this file
+# unless set, so every process finds the same queue whatever directory it runs in
+QUEUE_PATH = os.getenv(
+    "MEMORY_QUEUE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory_jobs.db"),
+)
+# the idempotency keys of queued batches that have been applied, under "applied_batches/"
+APPLIED_BATCHES = "applied_batches"
+# new topics at least this similar to an existing memory are added to it,
+# unset uses the default of the embedding model, the hashing fallback has none
+MATCH_THRESHOLD = os.getenv("MEMORY_MATCH_THRESHOLD")
+# stream plan and fast path responses, so memory blocks start before the plan is complete
+STREAM_RESPONSES = os.getenv("MEMORY_PIPELINE_STREAM", "1") == "1"
+# prompt token budgets for the parts of a prompt that grow with the batch,
+# a batch over the analysis budget has its topics extracted in several calls
+ANALYSIS_TRANSCRIPT_TOKENS = 6000
+PLAN_TRANSCRIPT_TOKENS = 2000
+PLAN_ANALYSIS_TOKENS = 3000
+BLOCK_CONTEXT_TOKENS = 1000
+# transcriptions either side of a topic's sentences passed to its memory block
+BLOCK_CONTEXT_NEIGHBOURS = 1
+
+_WORD = re.compile(r"[\w']+")
+
+
+def compact_json(data) -> str:
+    """Serialize prompt data without indentation or padding"""
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+def fit_to_budget(texts: List[str], max_tokens: int) -> List[str]:
+    """Keep texts in order until the token budget is used up"""
+    kept = []
+    used = 0
+    for text in texts:
+        used += estimate_tokens(text) + 1
+        if used > max_tokens:
+            break
+        kept.append(text)
+    return kept
+
+
+def split_to_budget(texts: List[str], max_tokens: int) -> List[List[str]]:
+    """
+    Cut texts, in order, into consecutive runs that each fit the token budget.
+    A text over the budget on its own is cut short.
+    """
+    runs = []
+    current = []
+    used = 0
+    for text in texts:
+        if estimate_tokens(text) + 1 > max_tokens:
+            text = text[:(max_tokens - 1) * 4]
+        cost = estimate_tokens(text) + 1
+        if current and used + cost > max_tokens:
+            runs.append(current)
+            current = []
+            used = 0
+        current.append(text)
+        used += cost
+    if current:
+        runs.append(current)
+    return runs
+
+
+def stamp_update(update: Dict) -> Dict:
+    """
+    Set the time a memory update was written. It is added after the call
+    rather than asked for in the prompt, so the prompt stays cacheable.
+    """
+    content = update.get("content")
+    if isinstance(content, dict):
+        metadata = content.get("metadata")
+        if not isinstance(metadata, dict):
+            metadata = content["metadata"] = {}
+        metadata["timestamp"] = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
+    return update
+
+
+def _parse_timestamp(timestamp) -> datetime | None:
+    try:
+        return datetime.strptime(timestamp, "%Y-%m-%d %H-%M-%S")
+    except (TypeError, ValueError):
+        return None
+
+
+def shard_transcriptions(
+    transcriptions: Dict, max_tokens: int, max_items: int, max_gap: float
+) -> List[Dict]:
+    """
+    Cut transcriptions, in key order, into contiguous shards of at most
+    ``max_items`` transcriptions and about ``max_tokens`` tokens of text.
+    A new shard also starts after more than ``max_gap`` seconds of silence,
+    where a conversation has most likely ended.
+    """
+    shards = []
+    current = {}
+    tokens = 0
+    previous = None
+    for key, transcription in transcriptions.items():
+        text_tokens = estimate_tokens(transcription.get("text") or "")
+        timestamp = _parse_timestamp(transcription.get("timestamp"))
+        gap = (
+            timestamp is not None
+            and previous is not None
+            and (timestamp - previous).total_seconds() > max_gap
+        )
+        if current and (len(current) >= max_items or tokens + text_tokens > max_tokens or gap):
+            shards.append(current)
+            current = {}
+            tokens = 0
+        current[key] = transcription
+        tokens += text_tokens
+        previous = timestamp or previous
+    if current:
+        shards.append(current)
+    return shards
+
+
+def _words(text: str) -> set:
+    return {word.lower() for word in _WORD.findall(text)}
+
+
+def find_topic(analysis: Dict | None, name: str) -> Dict | None:
+    """Find the analyzed topic a memory block was planned for"""
+    if not analysis:
+        return None
+    topics = analysis.get("topics", [])
+    wanted = name.strip().lower()
+    for topic in topics:
+        if topic.get("name", "").strip().lower() == wanted:
+            return topic
+    for topic in topics:
+        topic_name = topic.get("name", "").strip().lower()
+        if topic_name and (topic_name in wanted or wanted in topic_name):
+            return topic
+    names = [topic.get("name", "") for topic in topics]
+    matches = difflib.get_close_matches(name, names, n=1, cutoff=0.6)
+    return topics[names.index(matches[0])] if matches else None
+
+
+def summarize_analysis(analysis: Dict, max_tokens: int) -> Dict:
+    """
+    What the plan needs of the analysis: each topic with its tone, importance
+    and conversation thread, but not its sentences, which only the memory
+    block calls get. Thread contexts are cut to share the token budget, and
+    with too many topics for even that only their names are kept.
+    """
+    topics = analysis.get("topics", [])
+    threads = {
+        str(thread.get("topic", "")).strip().lower(): thread
+        for thread in analysis.get("context", [])
+        if isinstance(thread, dict)
+    }
+    # a few tokens per topic go to its name and the other fields
+    share = max(0, max_tokens // max(1, len(topics)) - 30)
+    summary = {"topics": []}
+    for topic in topics:
+        entry = {
+            "name": topic.get("name", ""),
+            "emotional_tone": topic.get("emotional_tone"),
+            "importance": topic.get("importance"),
+        }
+        thread = threads.get(entry["name"].strip().lower())
+        if thread:
+            entry["context"] = str(thread.get("context", ""))[:share * 4]
+            entry["sentiment"] = thread.get("sentiment")
+            entry["continuation"] = thread.get("continuation")
+        summary["topics"].append(entry)
+    if estimate_tokens(compact_json(summary)) > max_tokens:
+        summary = {"topics": [{"name": entry["name"]} for entry in summary["topics"]]}
+    return summary
+
+
+def slice_for_block(
+    block: Dict, transcriptions: Dict, analysis: Dict | None
+) -> tuple[List[str], List[str]]:
+    """
+    Pick what a memory block prompt needs: the sentences analyze_transcriptions
+    assigned to its topic, and the transcriptions they came from plus a few
+    neighbours, within BLOCK_CONTEXT_TOKENS.
+    """
+    texts = [t.get("text", "") for t in transcriptions.values()]
+    topic = find_topic(analysis, block.get("topic", ""))
+    sentences = topic.get("sentences", []) if topic else []
+    if not sentences:
+        return [], fit_to_budget(texts, BLOCK_CONTEXT_TOKENS)
+
+    text_words = [_words(text) for text in texts]
+    hits = set()
+    for sentence in sentences:
+        words = _words(sentence)
+        if not words:
+            continue
+        overlaps = [len(words & candidate) / len(words) for candidate in text_words]
+        best = max(range(len(texts)), key=overlaps.__getitem__, default=None)
+        if best is not None and overlaps[best] >= 0.5:
+            hits.add(best)
+
+    window = sorted(
+        {
+            index
+            for hit in hits
+            for index in range(hit - BLOCK_CONTEXT_NEIGHBOURS, hit + BLOCK_CONTEXT_NEIGHBOURS + 1)
+            if 0 <= index < len(texts)
+        }
+    )
+    return sentences, fit_to_budget([texts[index] for index in window], BLOCK_CONTEXT_TOKENS)
 
 
 class MemoryProcessor:
     """Handles the processing pipeline for memory management"""
 
-    def __init__(self, db: Database, client: GroqClient):
+    def __init__(
+        self,
+        db: Database,
+        client: GroqClient,
+        max_concurrency: int = 4,
+        block_timeout: float | None = 60.0,
+        stream: bool = STREAM_RESPONSES,
+    ):
         self.db = db
         self.client = client
+        # how many memory blocks are written at the same time
+        self.max_concurrency = max_concurrency
+        # seconds the memory block calls of a batch may take, from when the
+        # first is waited on; a block call is not retried within it
+        self.block_timeout = block_timeout
+        self.stream = stream
 
     def analyze_transcriptions(
         self, transcriptions: Dict
@@ -25,36 +281,14 @@ class MemoryProcessor:
         print("\n=== INITIAL ANALYSIS PHASE ===")
 
         try:
-            # First, extract raw topics
-            topic_prompt = f"""
-You are an expert conversation analyst. Extract the main topics from these transcriptions.
-Focus only on the actual content, not the metadata or structure.
-
-Transcriptions:
-{json.dumps([t.get('text', '') for t in transcriptions.values()], indent=2)}
-
-RETURN ONLY THE JSON OBJECT BELOW - NO OTHER TEXT.
-You MUST return your response in this EXACT format:
-{{
-    "topics": [
-        {{
-            "name": "clear_topic_name",
-            "sentences": ["relevant sentence 1", "relevant sentence 2"],
-            "emotional_tone": "brief tone description",
-            "importance": 1-5
-        }}
-    ]
-}}
-
-REQUIREMENTS:
-1. Each topic MUST have a "name" field
-2. Group relevant sentences under each topic
-3. Include emotional tone and importance
-4. Use clear, specific topic names
-5. DO NOT include any text before or after the JSON. Return ONLY the JSON object.
-"""
-            topic_response = self.client.generate_text(topic_prompt)
-            topics = json.loads(topic_response.strip().lstrip("```json").rstrip("```"))
+            # First, extract raw topics, in parts if the batch is over the budget
+            texts = [t.get("text", "") for t in transcriptions.values()]
+            topics = {"topics": []}
+            for part in split_to_budget(texts, ANALYSIS_TRANSCRIPT_TOKENS):
+                with span("memory", "analyze_topics", transcriptions=len(part)):
+                    topic_response = self.client.generate_text(self._topic_prompt(part))
+                part_topics = json.loads(topic_response.strip().lstrip("```json").rstrip("```"))
+                topics["topics"].extend(part_topics.get("topics") or [])
 
             print("\nExtracted Topics:")
             print(json.dumps(topics, indent=2))
@@ -74,7 +308,7 @@ You are a conversation context analyzer. Create conversation threads from these
 DO NOT repeat the input format. Create NEW conversation threads.
 
 For each of these topics:
-{json.dumps([t["name"] for t in topics["topics"]], indent=2)}
+{compact_json([t["name"] for t in topics["topics"]])}
 
 RETURN ONLY THE JSON OBJECT BELOW - NO OTHER TEXT.
 Create a conversation thread analysis that follows this EXACT format:
@@ -98,7 +332,8 @@ REQUIREMENTS:
 5. Do not include any other fields or formats
 6. Return ONLY the JSON object above. NO text before or after.
 """
-            context_response = self.client.generate_text(context_prompt)
+            with span("memory", "analyze_context"):
+                context_response = self.client.generate_text(context_prompt)
             print("\nRaw Context Response:")
             print(context_response)
 
@@ -182,18 +417,71 @@ REQUIREMENTS:
             print(f"Unexpected error in analysis: {e}")
             raise
 
+    def _topic_prompt(self, texts: List[str]) -> str:
+        """Prompt that extracts the topics of a run of transcriptions"""
+        return f"""
+You are an expert conversation analyst. Extract the main topics from these transcriptions.
+Focus only on the actual content, not the metadata or structure.
+
+Transcriptions:
+{compact_json(texts)}
+
+RETURN ONLY THE JSON OBJECT BELOW - NO OTHER TEXT.
+You MUST return your response in this EXACT format:
+{{
+    "topics": [
+        {{
+            "name": "clear_topic_name",
+            "sentences": ["relevant sentence 1", "relevant sentence 2"],
+            "emotional_tone": "brief tone description",
+            "importance": 1-5
+        }}
+    ]
+}}
+
+REQUIREMENTS:
+1. Each topic MUST have a "name" field
+2. Group relevant sentences under each topic
+3. Include emotional tone and importance
+4. Use clear, specific topic names
+5. DO NOT include any text before or after the JSON. Return ONLY the JSON object.
+"""
+
     def plan_memory_updates(self, analysis: Dict, transcriptions: Dict) -> Dict:
         """Second step: Plan memory block updates"""
         print("\n=== PLANNING PHASE ===")
 
-        planning_prompt = f"""
+        planning_prompt = self._planning_prompt(analysis, transcriptions)
+        try:
+            with span("memory", "plan"):
+                plan_response = self.client.generate_text(planning_prompt)
+            plan = json.loads(plan_response.strip().lstrip("```json").rstrip("```"))
+
+            print("\nMemory Block Plan:")
+            print(json.dumps(plan, indent=2))
+
+            if not plan.get("memory_blocks"):
+                raise ValueError("Invalid plan format: missing memory_blocks")
+
+            return plan
+
+        except (json.JSONDecodeError, KeyError) as e:
+            print(f"Error in planning phase: {e}")
+            print("Raw response:", plan_response)
+            # pylint: disable=raise-missing-from
+            raise ValueError("Invalid planning response from LLM")
+
+    def _planning_prompt(self, analysis: Dict, transcriptions: Dict) -> str:
+        # the plan works from the topics, the raw text is only context
+        texts = [t.get("text", "") for t in transcriptions.values()]
+        return f"""
 You are a memory organization expert. Create a plan to organize these conversations into memory blocks.
 
 Analysis:
-{json.dumps(analysis, indent=2)}
+{compact_json(summarize_analysis(analysis, PLAN_ANALYSIS_TOKENS))}
 
 Raw Transcriptions:
-{json.dumps([t.get('text', '') for t in transcriptions.values()], indent=2)}
+{compact_json(fit_to_budget(texts, PLAN_TRANSCRIPT_TOKENS))}
 
 RETURN ONLY THE JSON OBJECT BELOW - NO OTHER TEXT.
 You MUST return your response in this EXACT format:
@@ -220,38 +508,127 @@ Requirements:
 5. The response MUST have a 'memory_blocks' key at the root level
 6. Return ONLY the JSON object above. DO NOT include any explanatory text.
 """
-        try:
-            plan_response = self.client.generate_text(planning_prompt)
-            plan = json.loads(plan_response.strip().lstrip("```json").rstrip("```"))
 
+    def execute_memory_updates(
+        self, plan: Dict, transcriptions: Dict, analysis: Dict | None = None
+    ) -> Dict:
+        """Final step: Create actual memory block content"""
+        print("\n=== EXECUTION PHASE ===")
+
+        blocks = plan.get("memory_blocks", [])
+        # every block is written by its own call, so run them side by side
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(self.max_concurrency, len(blocks)))
+        ) as executor:
+            futures = [
+                # a copy of the context per block keeps its span under the current one
+                executor.submit(
+                    copy_context().run, self._execute_memory_block, block, transcriptions, analysis
+                )
+                for block in blocks
+            ]
+            with span("memory", "execute"):
+                return self._collect_memory_updates(blocks, futures)
+
+    def plan_and_execute_memory_updates(
+        self, analysis: Dict, transcriptions: Dict
+    ) -> tuple[Dict, Dict]:
+        """
+        Second and final step together: stream the plan and start writing each
+        memory block as soon as the plan has described it
+        """
+        print("\n=== STREAMED PLANNING AND EXECUTION PHASE ===")
+
+        planning_prompt = self._planning_prompt(analysis, transcriptions)
+        blocks = []
+        futures = []
+        executor = ThreadPoolExecutor(max_workers=max(1, self.max_concurrency))
+        # blocks belong to the batch rather than to the plan they overlap with
+        outside = copy_context()
+        try:
+            try:
+                with span("memory", "plan"):
+                    for block in stream_items(
+                        self.client.stream_text(planning_prompt),
+                        "memory_blocks",
+                        validate=lambda block: "topic" in block and "structure" in block,
+                    ):
+                        print(f"Planned memory block: {block.get('topic')}")
+                        blocks.append(block)
+                        futures.append(
+                            executor.submit(
+                                outside.copy().run,
+                                self._execute_memory_block,
+                                block,
+                                transcriptions,
+                                analysis,
+                            )
+                        )
+            except ValueError as e:
+                # closing the stream above stops the rest of the plan from being generated
+                print(f"Error in planning phase: {e}")
+                # pylint: disable=raise-missing-from
+                raise ValueError("Invalid planning response from LLM")
+
+            plan = {"memory_blocks": blocks}
             print("\nMemory Block Plan:")
             print(json.dumps(plan, indent=2))
-
-            if not plan.get("memory_blocks"):
+            if not blocks:
                 raise ValueError("Invalid plan format: missing memory_blocks")
 
-            return plan
+            print("\n=== EXECUTION PHASE ===")
+            with span("memory", "execute"):
+                return plan, self._collect_memory_updates(blocks, futures)
+        finally:
+            # whatever stopped the plan, blocks that have not started are not written
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _collect_memory_updates(self, blocks: List[Dict], futures: List) -> Dict:
+        """
+        Wait for the memory block calls, in plan order, skipping failed ones
+        and the ones still running when the block timeout has passed
+        """
+        deadline = (
+            time.monotonic() + self.block_timeout if self.block_timeout is not None else None
+        )
+        memory_updates = []
+        for block, future in zip(blocks, futures):
+            try:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                memory_updates.append(future.result(timeout=remaining))
+            except FuturesTimeoutError:
+                print(f"Memory block {block.get('topic')} timed out")
+                future.cancel()
+                continue
+            # pylint: disable=broad-exception-caught
+            except Exception as e:
+                print(f"Error processing memory block {block.get('topic')}: {e}")
+                continue
 
-        except (json.JSONDecodeError, KeyError) as e:
-            print(f"Error in planning phase: {e}")
-            print("Raw response:", plan_response)
-            # pylint: disable=raise-missing-from
-            raise ValueError("Invalid planning response from LLM")
+        if not memory_updates:
+            raise ValueError("No valid memory updates generated")
 
-    def execute_memory_updates(self, plan: Dict, transcriptions: Dict) -> Dict:
-        """Final step: Create actual memory block content"""
-        print("\n=== EXECUTION PHASE ===")
+        result = {"memory_updates": memory_updates}
+        print("\nGenerated Memory Updates:")
+        print(json.dumps(result, indent=2))
+        return result
 
-        memory_updates = []
-        for block in plan.get("memory_blocks", []):
-            content_prompt = f"""
+    def _execute_memory_block(
+        self, block: Dict, transcriptions: Dict, analysis: Dict | None = None
+    ) -> Dict:
+        """Create the content for a single memory block"""
+        sentences, context = slice_for_block(block, transcriptions, analysis)
+        content_prompt = f"""
 You are a precise memory writer. Create the content for this memory block:
 
 Memory Block Plan:
-{json.dumps(block, indent=2)}
+{compact_json(block)}
 
-Available Transcriptions:
-{json.dumps([t.get('text', '') for t in transcriptions.values()], indent=2)}
+Topic Sentences:
+{compact_json(sentences)}
+
+Surrounding Transcriptions:
+{compact_json(context)}
 
 RETURN ONLY THE JSON OBJECT BELOW - NO OTHER TEXT.
 You MUST return your response in this EXACT format:
@@ -267,7 +644,6 @@ You MUST return your response in this EXACT format:
             "metadata": {{
                 "emotional_tone": "specific tone",
                 "importance_level": 1-5,
-                "timestamp": "{datetime.now().strftime('%Y-%m-%d %H-%M-%S')}",
                 "conversation_type": "type of conversation",
                 "visual_style": "style of visual representation"
             }}
@@ -276,89 +652,134 @@ You MUST return your response in this EXACT format:
 }}
 
 Requirements:
-1. Include ALL relevant sentences from transcriptions
+1. Include ALL topic sentences, use the surrounding transcriptions only for context
 2. Maintain original meaning and context
 3. Clean up and format sentences properly
 4. Include meaningful metadata
 5. The response MUST have a 'memory_update' key at the root level
 6. Return ONLY the JSON object above. NO text before or after. NO explanations.
 """
-            try:
-                content_response = self.client.generate_text(content_prompt)
-                content = json.loads(
-                    content_response.strip().lstrip("```json").rstrip("```")
-                )
+        with span("memory", "execute_block", topic=block.get("topic")):
+            content_response = self.client.generate_text(
+                content_prompt, timeout=self.block_timeout, max_retries=0
+            )
+        try:
+            content = json.loads(
+                content_response.strip().lstrip("```json").rstrip("```")
+            )
 
-                if not content.get("memory_update"):
-                    raise ValueError("Invalid memory update format")
+            if not content.get("memory_update"):
+                raise ValueError("Invalid memory update format")
 
-                memory_updates.append(content["memory_update"])
+            return stamp_update(content["memory_update"])
+        except Exception:
+            print("Raw response:", content_response)
+            raise
 
-            # pylint: disable=broad-exception-caught
-            except Exception as e:
-                print(f"Error processing memory block {block.get('topic')}: {e}")
-                print("Raw response:", content_response)
-                continue
+    def generate_memory_updates_fast(self, transcriptions: Dict) -> Dict:
+        """Single step: Go straight from transcriptions to memory updates in one call"""
+        print("\n=== FAST PATH PHASE ===")
 
-        if not memory_updates:
-            raise ValueError("No valid memory updates generated")
+        fast_prompt = f"""
+You are an expert conversation analyst and precise memory writer.
+Group these transcriptions into topics and write one memory block per topic.
+Focus only on the actual content, ignore filler or noise.
 
-        result = {"memory_updates": memory_updates}
-        print("\nGenerated Memory Updates:")
-        print(json.dumps(result, indent=2))
-        return result
+Transcriptions:
+{compact_json([t.get('text', '') for t in transcriptions.values()])}
+
+RETURN ONLY THE JSON OBJECT BELOW - NO OTHER TEXT.
+You MUST return your response in this EXACT format:
+{{
+    "memory_updates": [
+        {{
+            "action": "create",
+            "content": {{
+                "topic": "clear_topic_name",
+                "sentences": ["complete sentence 1", "complete sentence 2"],
+                "summary": "brief summary of the content",
+                "context": "detailed context",
+                "dalle_prompt": "prompt for dalle 3 based on the content of the conversation",
+                "metadata": {{
+                    "emotional_tone": "specific tone",
+                    "importance_level": 1-5,
+                    "conversation_type": "type of conversation",
+                    "visual_style": "style of visual representation"
+                }}
+            }}
+        }}
+    ]
+}}
+
+Requirements:
+1. Create one memory update for EACH distinct topic
+2. Include ALL relevant sentences from the transcriptions, cleaned up and formatted properly
+3. Only group sentences that are right after each other, the transcriptions are in chronological order
+4. Maintain original meaning and context
+5. The response MUST have a 'memory_updates' key at the root level
+6. Return ONLY the JSON object above. NO text before or after. NO explanations.
+"""
+        try:
+            with span("memory", "fast"):
+                if self.stream:
+                    # a malformed response is abandoned at its first bad item
+                    result = {
+                        "memory_updates": list(
+                            stream_items(
+                                self.client.stream_text(fast_prompt),
+                                "memory_updates",
+                                validate=lambda update: "action" in update and "content" in update,
+                            )
+                        )
+                    }
+                else:
+                    fast_response = self.client.generate_text(fast_prompt, json_mode=True)
+                    result = json.loads(fast_response.strip().lstrip("```json").rstrip("```"))
+
+            print("\nGenerated Memory Updates:")
+            print(json.dumps(result, indent=2))
+
+            if not result.get("memory_updates"):
+                raise ValueError("No memory updates in fast path response")
+
+            for update in result["memory_updates"]:
+                stamp_update(update)
+            return result
+
+        except (ValueError, AttributeError) as e:
+            print(f"Error in fast path: {e}")
+            # pylint: disable=raise-missing-from
+            raise ValueError(f"Invalid fast path response from LLM: {e}")
 
 
 class MemoryManager:
     """Manages the entire memory processing pipeline"""
 
-    def __init__(self):
+    def __init__(self, db: Database | None = None, client: GroqClient | None = None):
         self.last_run = datetime.now()
-        self.db = Database()
-        self.client = GroqClient(GroqModelConfig(temperature=0.3))
+        self.db = db or Database()
+        self.client = client or GroqClient(
+            GroqModelConfig(temperature=0.3, cache_path=os.getenv("GROQ_CACHE_PATH"))
+        )
         self.processor = MemoryProcessor(self.db, self.client)
+        self.pipeline_mode = PIPELINE_MODE
+        self.batch_size = BATCH_SIZE
+        # key of the last transcription that was processed, as of the last commit
+        self.cursor = None
+        # existing memories by topic, built from the database on the first batch;
+        # the embedding model is loaded then too, so starting up stays fast
+        self.index: MemoryIndex | None = None
+        self._index_loaded = False
+        # memories written by the batch being applied, by id
+        self._batch_memories = {}
         self.processing_stats = {
             "total_processed": 0,
             "successful_updates": 0,
             "failed_updates": 0,
-            "last_error": None,
         }
 
-    def process_transcriptions(self):
-        """Main processing pipeline for transcriptions"""
-        try:
-            print("\n========== STARTING MEMORY PROCESSING ==========")
-            print(f"Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-
-            # Get transcriptions from the last minute (with 2s buffer)
-            current = datetime.now()
-            minute_ago = (current - timedelta(seconds=62)).strftime("%Y-%m-%d %H-%M-%S")
-
-            # Fetch and validate transcriptions
-            new_transcriptions = self._fetch_transcriptions(minute_ago)
-            if not new_transcriptions:
-                return
-
-            # Process the transcriptions
-            self._process_batch(new_transcriptions)
-        # pylint: disable=broad-exception-caught
-        except Exception as e:
-            self._handle_error(e)
-        finally:
-            self._update_stats()
-            self._log_completion(current)
-
-    def _fetch_transcriptions(self, since_timestamp: str) -> Dict:
-        """Fetch and validate new transcriptions"""
-        new_transcriptions = self.db.get_transcriptions(since_timestamp)
-
-        if not new_transcriptions:
-            print("No new transcriptions to process")
-            return {}
-
-        print(f"\nFetched {len(new_transcriptions)} new transcriptions")
-
-        # Validate transcriptions
+    def _valid_transcriptions(self, new_transcriptions: Dict) -> Dict:
+        """Drop invalid transcriptions from a batch"""
         valid_transcriptions = {}
         for key, trans in new_transcriptions.items():
             if self._validate_transcription(trans):
@@ -375,34 +796,296 @@ class MemoryManager:
             field in transcription and transcription[field] for field in required_fields
         )
 
-    def _process_batch(self, transcriptions: Dict):
-        """Process a batch of transcriptions"""
-        # Get existing memories for context
-        existing_memories = self.db.get_memories() or {}
-        print(f"Current memory blocks: {len(existing_memories)}")
+    def enqueue_batches(self, queue: JobQueue) -> int:
+        """
+        Queue a job for each batch of transcriptions after the last queued one.
+
+        A backlog is cut into time-contiguous batches within BATCH_MAX_TOKENS
+        that end where the conversation paused, so the workers catch up on it
+        side by side. A batch is named by the keys it starts after and ends
+        at, so queueing it again, e.g. from another process, does nothing.
+        Transcriptions left behind the cursor are queued as a batch of their own.
+        """
+        # the jobs before the cursor, so a batch committed in between is in both
+        unfinished = queue.unfinished(BATCH_JOB)
+        cursor = (self.db.get_cursor(CURSOR_NAME) or {}).get("key")
+        after = max([cursor or ""] + [job.payload["last"] for job in unfinished]) or None
+
+        queued = 0
+        with span("memory", "enqueue") as enqueue:
+            queued += self._enqueue_left_behind(queue, unfinished, cursor)
+            while True:
+                page = self.db.get_transcriptions_after(after, self.batch_size)
+                if not page:
+                    break
+                shards = shard_transcriptions(
+                    page, BATCH_MAX_TOKENS, self.batch_size, BATCH_GAP_SECONDS
+                )
+                full = len(page) == self.batch_size
+                if full and len(shards) > 1:
+                    # the last shard may go on in the next page, it is read again with it
+                    shards.pop()
+                for shard in shards:
+                    last = next(reversed(shard))
+                    if queue.enqueue(
+                        BATCH_JOB, f"{after or 'start'}~{last}", {"after": after, "last": last}
+                    ):
+                        queued += 1
+                    after = last
+                if not full:
+                    break
+            enqueue.set(jobs=queued)
+
+        if queued:
+            print(f"\nQueued {queued} batches of transcriptions, up to {after}")
+        return queued
+
+    def _enqueue_left_behind(
+        self, queue: JobQueue, unfinished: List[Job], cursor: str | None
+    ) -> int:
+        """
+        Queue the valid transcriptions at or before the cursor that no queued
+        batch covers. Push keys come from the clocks of the machines that
+        write them, so a transcription can land behind a batch that was
+        already generated or committed, and would otherwise never be read.
+        """
+        if cursor is None:
+            return 0
+        keys = set()
+        ranges = []
+        for job in unfinished:
+            if "keys" in job.payload:
+                keys.update(job.payload["keys"])
+            else:
+                ranges.append((job.payload["after"], job.payload["last"]))
+
+        left_behind = [
+            key
+            for key, transcription in self.db.get_transcriptions_until(
+                cursor, self.batch_size
+            ).items()
+            if self._validate_transcription(transcription)
+            and key not in keys
+            and not any((after is None or key > after) and key <= last for after, last in ranges)
+        ]
+        if not left_behind:
+            return 0
+        print(f"\nFound {len(left_behind)} transcriptions behind the cursor")
+        count("memory", "left_behind", len(left_behind))
+        return int(queue.enqueue(
+            BATCH_JOB,
+            f"behind~{left_behind[0]}~{left_behind[-1]}~{len(left_behind)}",
+            {"keys": left_behind, "last": left_behind[-1]},
+        ))
+
+    def run_batch_job(self, job: Job) -> Dict:
+        """Turn a queued batch into memory updates, workers do this side by side"""
+        if self.db.get_applied_batch(job.key):
+            return {"applied": True}
+
+        payload = job.payload
+        if "keys" in payload:
+            # transcriptions found behind the cursor
+            raw = {}
+            for key in payload["keys"]:
+                transcription = self.db.get_transcription(key)
+                if transcription:
+                    raw[key] = transcription
+        else:
+            # a key range, with anything written into it since the batch was queued
+            raw = self.db.get_transcriptions_between(payload["after"], payload["last"])
+        transcriptions = self._valid_transcriptions(raw)
+        with span("memory", "batch", transcriptions=len(transcriptions)):
+            memory_updates = self._generate_updates(transcriptions) if transcriptions else {}
+        return {"transcriptions": transcriptions, "memory_updates": memory_updates}
+
+    def commit_batch_job(self, job: Job, result: Dict):
+        """
+        Apply the memory updates of a queued batch. Batches are committed one
+        at a time in queue order, and the batch's key is written along with
+        its updates, so a batch that was committed before is not applied again.
+        """
+        if result.get("applied") or self.db.get_applied_batch(job.key):
+            print(f"Batch {job.key} was already applied")
+            return
+
+        # another worker may have added memories since this one last committed
+        cursor = (self.db.get_cursor(CURSOR_NAME) or {}).get("key")
+        if cursor != self.cursor:
+            self._index_loaded = False
+            self.cursor = cursor
+
+        self._apply_batch(
+            result["transcriptions"], job.payload["last"], result["memory_updates"], job
+        )
+        self.last_run = datetime.now()
 
+    def _apply_batch(
+        self,
+        transcriptions: Dict,
+        last_key: str,
+        memory_updates: Dict,
+        job: Job | None = None,
+    ):
+        """
+        Write the memory updates, the cleanup and the new cursor in one update,
+        along with the key of the queued job the batch came from, if any.
+        """
+        if self.index is None:
+            self.index = MemoryIndex(
+                create_embedder(os.getenv("MEMORY_EMBEDDING_MODEL")),
+                float(MATCH_THRESHOLD) if MATCH_THRESHOLD else None,
+            )
+        if not self._index_loaded:
+            # Get existing memories to match new topics against
+            existing_memories = self.db.get_memories() or {}
+            self.index.rebuild(existing_memories)
+            self._index_loaded = True
+        print(f"Current memory blocks: {len(self.index)}")
+
+        batch = self.db.batch()
+        applied = 0
+        if transcriptions:
+            # Step 4: Apply updates
+            with span("memory", "apply"):
+                applied = self._apply_updates(memory_updates.get("memory_updates", []), batch)
+
+            # Step 5: Cleanup
+            with span("memory", "cleanup"):
+                self._cleanup_transcriptions(transcriptions, batch)
+
+        self._advance_cursor(last_key, transcriptions, batch)
+        if job is not None:
+            batch.set(
+                f"{APPLIED_BATCHES}/{job.key}",
+                {
+                    "job": job.id,
+                    "worker": job.worker,
+                    "applied": datetime.now().strftime("%Y-%m-%d %H-%M-%S"),
+                },
+            )
         try:
-            analysis = self.processor.analyze_transcriptions(transcriptions)
-            if not self._validate_analysis(analysis):
-                raise ValueError("Invalid analysis result")
+            if job is not None and not job.renew():
+                raise LeaseLost(f"lease on batch {job.key} expired before its commit")
+            with span("memory", "commit", writes=len(batch)):
+                batch.commit()
+        except Exception:
+            self.processing_stats["failed_updates"] += applied
+            count("memory", "failed_updates", applied)
+            # the index already has the memories of this batch, start over
+            self._index_loaded = False
+            raise
+        self.cursor = max(self.cursor or "", last_key)
+        self.processing_stats["successful_updates"] += applied
+        self.processing_stats["total_processed"] += len(transcriptions)
+        count("memory", "memory_updates", applied)
+        count("memory", "transcriptions", len(transcriptions))
+
+    def _advance_cursor(self, last_key: str, transcriptions: Dict, batch: WriteBatch):
+        """
+        Add the new cursor position to the batch. A batch retried after later
+        ones were committed leaves the cursor where it is.
+        """
+        if self.cursor is not None and last_key <= self.cursor:
+            return
+        last_timestamp = next(
+            (t["timestamp"] for t in reversed(transcriptions.values())), None
+        )
+        batch.set(
+            f"cursors/{CURSOR_NAME}",
+            {
+                "key": last_key,
+                "timestamp": last_timestamp,
+                "updated": datetime.now().strftime("%Y-%m-%d %H-%M-%S"),
+            },
+        )
+
+    def _generate_updates(self, transcriptions: Dict) -> Dict:
+        """Turn transcriptions into memory updates using the configured pipeline mode"""
+        if self.pipeline_mode == "fast" or (
+            self.pipeline_mode == "auto" and self._fits_fast_path(transcriptions)
+        ):
+            try:
+                memory_updates = self.processor.generate_memory_updates_fast(transcriptions)
+                if not self._validate_updates(memory_updates):
+                    raise ValueError("Invalid memory updates")
+                return memory_updates
+            # pylint: disable=broad-exception-caught
+            except Exception as e:
+                print(f"Fast path failed, falling back to staged pipeline: {e}")
+                count("memory", "fast_path_fallbacks")
+
+        return self._run_staged_pipeline(transcriptions)
 
+    def _fits_fast_path(self, transcriptions: Dict) -> bool:
+        """Whether a batch is small enough to process in a single call"""
+        total_chars = sum(len(t.get("text", "")) for t in transcriptions.values())
+        return (
+            len(transcriptions) <= FAST_PATH_MAX_TRANSCRIPTIONS
+            and total_chars <= FAST_PATH_MAX_CHARS
+        )
+
+    def _run_staged_pipeline(self, transcriptions: Dict) -> Dict:
+        """Analyze, plan and execute memory updates in separate calls"""
+        analysis = self.processor.analyze_transcriptions(transcriptions)
+        if not self._validate_analysis(analysis):
+            raise ValueError("Invalid analysis result")
+
+        if self.processor.stream:
+            update_plan, memory_updates = self.processor.plan_and_execute_memory_updates(
+                analysis, transcriptions
+            )
+        else:
             update_plan = self.processor.plan_memory_updates(analysis, transcriptions)
             if not self._validate_plan(update_plan):
                 raise ValueError("Invalid update plan")
 
-            memory_updates = self.processor.execute_memory_updates(update_plan, transcriptions)
-            if not self._validate_updates(memory_updates):
-                raise ValueError("Invalid memory updates")
-
-            # Step 4: Apply updates
-            self._apply_updates(memory_updates.get("memory_updates", []))
+            memory_updates = self.processor.execute_memory_updates(
+                update_plan, transcriptions, analysis
+            )
+        if not self._validate_updates(memory_updates):
+            raise ValueError("Invalid memory updates")
+        return memory_updates
+
+    def compare_pipeline_modes(self, transcriptions: Dict | None = None) -> Dict:
+        """Run both pipeline modes on the same batch without applying anything"""
+        if transcriptions is None:
+            cursor = (self.db.get_cursor(CURSOR_NAME) or {}).get("key")
+            transcriptions = self._valid_transcriptions(
+                self.db.get_transcriptions_after(cursor, self.batch_size)
+            )
+        if not transcriptions:
+            return {}
 
-            # Step 5: Cleanup
-            self._cleanup_transcriptions(transcriptions)
+        results = {}
+        runs = [
+            ("fast", self.processor.generate_memory_updates_fast),
+            ("staged", self._run_staged_pipeline),
+        ]
+        for mode, run in runs:
+            usage_before = dict(self.client.usage)
+            started = time.perf_counter()
+            try:
+                updates = run(transcriptions)
+                error = None
+            # pylint: disable=broad-exception-caught
+            except Exception as e:
+                updates, error = {}, str(e)
+            results[mode] = {
+                "latency_seconds": round(time.perf_counter() - started, 2),
+                "calls": self.client.usage["calls"] - usage_before["calls"],
+                "prompt_tokens": self.client.usage["prompt_tokens"] - usage_before["prompt_tokens"],
+                "completion_tokens": (
+                    self.client.usage["completion_tokens"] - usage_before["completion_tokens"]
+                ),
+                "memory_updates": len(updates.get("memory_updates", [])),
+                "error": error,
+            }
 
-        except Exception as e:
-            print(f"Error in processing batch: {str(e)}")
-            raise
+        print("\n=== PIPELINE MODE COMPARISON ===")
+        print(f"Transcriptions: {len(transcriptions)}")
+        print(json.dumps(results, indent=2))
+        return results
 
     def _validate_analysis(self, analysis: Dict) -> bool:
         """Validate the analysis output"""
@@ -438,22 +1121,26 @@ class MemoryManager:
             )
         )
 
-    def _apply_updates(self, updates: List[Dict]):
-        """Apply memory updates with error handling"""
+    def _apply_updates(self, updates: List[Dict], batch: WriteBatch) -> int:
+        """Add memory updates to the batch with error handling, return how many were added"""
         print(f"\nApplying {len(updates)} updates to memory system")
 
+        self._batch_memories = {}
+        applied = 0
         for i, update in enumerate(updates, 1):
             try:
                 print(f"\nUpdate {i}/{len(updates)}:")
-                self._apply_single_update(update)
-                self.processing_stats["successful_updates"] += 1
+                self._apply_single_update(update, batch)
+                applied += 1
             # pylint: disable=broad-exception-caught
             except Exception as e:
                 print(f"Error in update {i}: {str(e)}")
                 self.processing_stats["failed_updates"] += 1
+                count("memory", "failed_updates")
+        return applied
 
-    def _apply_single_update(self, update: Dict):
-        """Apply a single memory update"""
+    def _apply_single_update(self, update: Dict, batch: WriteBatch):
+        """Add a single memory update to the batch"""
         action = update.get("action")
         memory_id = update.get("memory_id")
         content = update.get("content")
@@ -462,30 +1149,41 @@ class MemoryManager:
             raise ValueError("Update missing content")
 
         if action == "create":
+            match = self.index.nearest(content)
+            if match:
+                print(f"Topic {content.get('topic')} matches {match[0]} ({match[1]:.2f})")
+                self._update_existing_memory(match[0], content, batch)
+                return
             print(f"Creating new memory block: {content.get('topic')}")
             content["timestamp"] = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
-            self.db.create_memory(content)
+            memory_id = batch.create("memories", content)
+            self._batch_memories[memory_id] = content
+            self.index.add(memory_id, content)
         elif action == "update" and memory_id:
-            self._update_existing_memory(memory_id, content)
+            self._update_existing_memory(memory_id, content, batch)
         elif action == "merge":
-            self._merge_memory_blocks(update)
+            self._merge_memory_blocks(update, batch)
         else:
             raise ValueError(f"Invalid action: {action}")
 
-    def _update_existing_memory(self, memory_id: str, content: Dict):
+    def _update_existing_memory(self, memory_id: str, content: Dict, batch: WriteBatch):
         """Update an existing memory block"""
         print(f"Updating memory block: {memory_id}")
         print(f"Topic: {content.get('topic')}")
 
-        existing = self.db.get_memory(memory_id)
+        existing = self._batch_memories.get(memory_id) or self.db.get_memory(memory_id)
         if not existing:
             raise ValueError(f"Memory block not found: {memory_id}")
 
         updated = self._merge_memory_content(existing, content)
-        self.db.update_memory(memory_id, updated)
+        # a memory created by this batch was merged into in place
+        if f"memories/{memory_id}" not in batch.updates:
+            batch.update("memories", memory_id, updated)
+        self._batch_memories[memory_id] = updated
+        self.index.add(memory_id, updated)
         print(f"Updated with {len(content.get('sentences', []))} new sentences")
 
-    def _merge_memory_blocks(self, update: Dict):
+    def _merge_memory_blocks(self, update: Dict, batch: WriteBatch):
         """Merge multiple memory blocks"""
         source_ids = update.get("source_memory_ids", [])
         content = update.get("content")
@@ -493,54 +1191,25 @@ class MemoryManager:
         print(f"Merging {len(source_ids)} memory blocks")
         print(f"New topic: {content.get('topic')}")
 
-        self.db.create_memory(content)
+        memory_id = batch.create("memories", content)
+        self._batch_memories[memory_id] = content
+        self.index.add(memory_id, content)
         for source_id in source_ids:
             print(f"Deleting merged block: {source_id}")
-            self.db.delete_memory(source_id)
+            batch.delete("memories", source_id)
+            self._batch_memories.pop(source_id, None)
+            self.index.remove(source_id)
 
-    def _cleanup_transcriptions(self, transcriptions: Dict):
+    def _cleanup_transcriptions(self, transcriptions: Dict, batch: WriteBatch):
         """Clean up processed transcriptions"""
         print(f"\nCleaning up {len(transcriptions)} processed transcriptions")
-        for key in transcriptions:
-            self.db.delete_transcription(key)
-            self.processing_stats["total_processed"] += 1
-
-    def _handle_error(self, error: Exception):
-        """Handle pipeline errors"""
-        print("\n!!! ERROR IN MEMORY PIPELINE !!!")
-        print(f"Error type: {type(error).__name__}")
-        print(f"Error message: {str(error)}")
-        print("Stack trace:")
-
-        traceback.print_exc()
-
-        self.processing_stats["last_error"] = {
-            "type": type(error).__name__,
-            "message": str(error),
-            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        }
-
-    def _update_stats(self):
-        """Update processing statistics"""
-        print("\n=== PROCESSING STATS ===")
-        print(f"Total processed: {self.processing_stats['total_processed']}")
-        print(f"Successful updates: {self.processing_stats['successful_updates']}")
-        print(f"Failed updates: {self.processing_stats['failed_updates']}")
-        last_error = self.processing_stats.get("last_error")
-        if last_error and isinstance(last_error, dict):
-            print(f"Last error: {last_error.get('message')}")
-
-    def _log_completion(self, start_time: datetime):
-        """Log completion status"""
-        print("\n=== PROCESSING COMPLETE ===")
-        print(f"Time taken: {datetime.now() - start_time}")
-        print("==========================================\n")
-        self.last_run = datetime.now()
+        for transcription_id in transcriptions:
+            batch.delete("transcriptions", transcription_id)
 
     def _merge_memory_content(self, existing: Dict, new: Dict) -> Dict:
         """Merge new content into existing memory block"""
-        existing["sentences"].extend(new.get("sentences", []))
-        existing["context"] = new.get("context", existing["context"])
+        existing.setdefault("sentences", []).extend(new.get("sentences", []))
+        existing["context"] = new.get("context", existing.get("context"))
         existing["emotional_tone"] = new.get(
             "emotional_tone", existing.get("emotional_tone")
         )
@@ -552,4 +1221,8 @@ class MemoryManager:
             **new.get("metadata", {}),
         }
         existing["last_updated"] = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
-        return existing
\ No newline at end of file
+        return existing
+
+
+if __name__ == "__main__":
+    MemoryManager().compare_pipeline_modes()
@@ -0,0 +1,52 @@
+"""
+Runs memory batch jobs from the queue, alongside the workers of the API server.
+"""
+
+import argparse
+import signal
+import threading
+
+from dotenv import load_dotenv
+
+from job_queue import JobQueue, Worker
+from memory_manager import BATCH_JOB, QUEUE_PATH, MemoryManager
+
+
+def main():
+    """Work on queued batches until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=1, help="worker threads")
+    parser.add_argument(
+        "--queue", default=QUEUE_PATH,
+        help="job queue database, shared with the API server",
+    )
+    parser.add_argument(
+        "--retry-failed", action="store_true", help="queue the failed batches again first"
+    )
+    args = parser.parse_args()
+
+    load_dotenv(override=True)
+    queue = JobQueue(args.queue)
+    if args.retry_failed:
+        print(f"Queued {queue.retry_failed(BATCH_JOB)} failed batches again")
+
+    manager = MemoryManager()
+    workers = [
+        Worker(queue, BATCH_JOB, manager.run_batch_job, manager.commit_batch_job).start()
+        for _ in range(args.workers)
+    ]
+    print(f"{len(workers)} memory workers on {args.queue}: {queue.counts(BATCH_JOB)}")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        stop.wait()
+    except KeyboardInterrupt:
+        pass
+    for worker in workers:
+        worker.stop()
+    queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+Local stand-in for the Groq (and OpenAI) chat completions API.
+
+Answers the memory pipeline prompts with deterministic JSON built from the
+transcriptions in the prompt, after a configurable delay, so the pipeline
+can be run and benchmarked without credentials or network access.
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm import estimate_tokens
+
+# transcriptions grouped into one topic by the canned responses
+SENTENCES_PER_TOPIC = 5
+STREAM_CHUNK_CHARS = 16
+
+_WORD = re.compile(r"[A-Za-z']+")
+
+
+def _section(prompt: str, label: str):
+    """Parse the JSON that follows a ``label:`` line in the prompt."""
+    start = prompt.find(f"{label}:\n")
+    if start == -1:
+        return None
+    try:
+        value, _end = json.JSONDecoder().raw_decode(prompt, start + len(label) + 2)
+        return value
+    except json.JSONDecodeError:
+        return None
+
+
+def _topic_name(sentences: list[str]) -> str:
+    words = [word.lower() for word in _WORD.findall(" ".join(sentences)) if len(word) > 3]
+    return " ".join(words[:3]) or "small talk"
+
+
+def _group(texts: list[str]) -> list[list[str]]:
+    return [
+        texts[i:i + SENTENCES_PER_TOPIC] for i in range(0, len(texts), SENTENCES_PER_TOPIC)
+    ] or [[]]
+
+
+def _memory_content(topic: str, sentences: list[str]) -> dict:
+    return {
+        "topic": topic,
+        "sentences": sentences,
+        "summary": f"Conversation about {topic}",
+        "context": " ".join(sentences)[:200],
+        "dalle_prompt": f"A watercolor illustration of {topic}",
+        "metadata": {
+            "emotional_tone": "neutral",
+            "importance_level": 3,
+            "timestamp": time.strftime("%Y-%m-%d %H-%M-%S"),
+            "conversation_type": "casual",
+            "visual_style": "watercolor",
+        },
+    }
+
+
+def canned_response(prompt: str) -> str:
+    """Answer a memory pipeline prompt in the format it asks for."""
+    if "Extract the main topics" in prompt:
+        texts = _section(prompt, "Transcriptions") or []
+        return json.dumps({
+            "topics": [
+                {
+                    "name": _topic_name(group),
+                    "sentences": group,
+                    "emotional_tone": "neutral",
+                    "importance": 3,
+                }
+                for group in _group(texts)
+            ]
+        })
+    if "Create conversation threads" in prompt:
+        names = _section(prompt, "For each of these topics") or []
+        return json.dumps({
+            "conversation_threads": [
+                {
+                    "topic": name,
+                    "context": f"Talking about {name}",
+                    "related_memories": [],
+                    "sentiment": "neutral",
+                    "continuation": "new",
+                }
+                for name in names
+            ]
+        })
+    if "organize these conversations into memory blocks" in prompt:
+        analysis = _section(prompt, "Analysis") or {}
+        return json.dumps({
+            "memory_blocks": [
+                {
+                    "topic": topic.get("name", "topic"),
+                    "type": "new_memory",
+                    "priority": 3,
+                    "structure": {
+                        "main_points": topic.get("sentences", [])[:2],
+                        "context": f"Talking about {topic.get('name')}",
+                        "sentiment": "neutral",
+                    },
+                }
+                for topic in analysis.get("topics", [])
+            ]
+        })
+    if "Create the content for this memory block" in prompt:
+        block = _section(prompt, "Memory Block Plan") or {}
+        sentences = _section(prompt, "Topic Sentences") or []
+        return json.dumps({
+            "memory_update": {
+                "action": "create",
+                "content": _memory_content(block.get("topic", "topic"), sentences),
+            }
+        })
+    if "write one memory block per topic" in prompt:
+        texts = _section(prompt, "Transcriptions") or []
+        return json.dumps({
+            "memory_updates": [
+                {"action": "create", "content": _memory_content(_topic_name(group), group)}
+                for group in _group(texts)
+            ]
+        })
+    return "This is a response from the local mock server."
+
+
+class MockGroqServer:
+    """
+    Serves chat completions on a local port from a background thread.
+
+    Every response takes ``latency`` seconds plus its completion tokens at
+    ``tokens_per_second``. ``responses`` maps prompt substrings to fixed
+    replies that take precedence over the canned ones, and with
+    ``rate_limit_every`` set every n-th request gets a 429.
+    """
+
+    def __init__(
+        self,
+        port: int = 0,
+        latency: float = 0.0,
+        tokens_per_second: float | None = None,
+        responses: dict | None = None,
+        rate_limit_every: int = 0,
+    ):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.responses = responses or {}
+        self.rate_limit_every = rate_limit_every
+        self.stats = {"requests": 0, "rate_limited": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Base URL for the Groq client, OpenAI clients need ``url + "/v1"``."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockGroqServer":
+        """Start serving in a background thread."""
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="mock-groq", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve in the calling thread until stopped."""
+        self._server.serve_forever()
+
+    def stop(self):
+        """Stop serving."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, prompt: str) -> str:
+        """The reply to a prompt."""
+        for marker, response in self.responses.items():
+            if marker in prompt:
+                return response
+        return canned_response(prompt)
+
+    def delay(self, completion_tokens: int) -> float:
+        """Seconds a response of this many tokens takes to generate."""
+        if not self.tokens_per_second:
+            return self.latency
+        return self.latency + completion_tokens / self.tokens_per_second
+
+    def count(self, prompt_tokens: int, completion_tokens: int) -> bool:
+        """Record a request, return False if it should be rate limited."""
+        with self._lock:
+            self.stats["requests"] += 1
+            if self.rate_limit_every and self.stats["requests"] % self.rate_limit_every == 0:
+                self.stats["rate_limited"] += 1
+                return False
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += completion_tokens
+            return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # pylint: disable=invalid-name
+    def do_POST(self):
+        """Handle a chat completions request."""
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        mock = self.server.mock
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        prompt = "\n".join(
+            message.get("content") or "" for message in request.get("messages", [])
+        )
+        response = mock.respond(prompt)
+        usage = {
+            "prompt_tokens": estimate_tokens(prompt),
+            "completion_tokens": estimate_tokens(response),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if not mock.count(usage["prompt_tokens"], usage["completion_tokens"]):
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "tokens"}},
+                {"retry-after": "1"},
+            )
+            return
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = request.get("model", "mock")
+        delay = mock.delay(usage["completion_tokens"])
+
+        if not request.get("stream"):
+            time.sleep(delay)
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": response},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        pieces = [
+            response[i:i + STREAM_CHUNK_CHARS]
+            for i in range(0, len(response), STREAM_CHUNK_CHARS)
+        ] or [""]
+        try:
+            for index, piece in enumerate(pieces):
+                time.sleep(delay / len(pieces))
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"role": "assistant", "content": piece} if index == 0
+                        else {"content": piece},
+                        "finish_reason": "stop" if index == len(pieces) - 1 else None,
+                    }],
+                }
+                if index == len(pieces) - 1:
+                    chunk["x_groq"] = {"id": completion_id, "usage": usage}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading, e.g. after malformed output
+            pass
+
+    def _send_json(self, status: int, body: dict, headers: dict | None = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def main():
+    """Run the mock server until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument(
+        "--tokens-per-second", type=float, help="completion speed, unlimited if not set"
+    )
+    parser.add_argument(
+        "--responses", help="JSON file of {prompt substring: response} overrides"
+    )
+    parser.add_argument(
+        "--rate-limit-every", type=int, default=0, help="answer every n-th request with a 429"
+    )
+    args = parser.parse_args()
+
+    responses = None
+    if args.responses:
+        with open(args.responses, encoding="utf-8") as file:
+            responses = json.load(file)
+
+    server = MockGroqServer(
+        args.port, args.latency, args.tokens_per_second, responses, args.rate_limit_every
+    )
+    print(f"Mock Groq server on {server.url}, set GROQ_BASE_URL={server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Token-bucket scheduling for requests against per-minute API quotas.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Holds up to ``capacity`` units and refills at ``capacity`` per ``period`` seconds.
+
+    The level may go below zero when a caller is charged more than it
+    reserved, later callers then wait for the debt to be paid off.
+    """
+
+    def __init__(self, capacity: float, period: float = 60.0):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until ``amount`` units are available, 0 if they are now."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        """Remove units, the level may go negative."""
+        self._refill()
+        self.level -= amount
+
+
+class RateLimiter:
+    """
+    Waits until a request fits into both the requests and tokens per minute quotas.
+
+    Either limit may be None to leave it unbounded. Callers reserve an
+    estimate before sending and settle the difference with the real usage
+    afterwards, so long completions slow down the requests that follow.
+    Coroutines wait with ``acquire`` and threads with ``wait``; both draw
+    from the same buckets.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+    ):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._buckets_lock = threading.Lock()
+        # set by pause, holds requests back even when neither limit is set
+        self._paused_until = 0.0
+        # one waiter at a time keeps requests in the order they arrived
+        self._async_lock = asyncio.Lock()
+        self._thread_lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        """Reserve room for a request and return 0, or return how long to wait for it."""
+        with self._buckets_lock:
+            wait = max(
+                self._paused_until - time.monotonic(),
+                self.requests.delay(1) if self.requests else 0.0,
+                self.tokens.delay(tokens) if self.tokens else 0.0,
+            )
+            if wait > 0:
+                return wait
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+            return 0.0
+
+    async def acquire(self, tokens: int = 0):
+        """Wait for room for one request of about ``tokens`` tokens and reserve it."""
+        async with self._async_lock:
+            while (wait := self._reserve(tokens)) > 0:
+                await asyncio.sleep(wait)
+
+    def wait(self, tokens: int = 0):
+        """Block the calling thread until there is room for the request, and reserve it."""
+        with self._thread_lock:
+            while (wait := self._reserve(tokens)) > 0:
+                time.sleep(wait)
+
+    def settle(self, reserved: int, used: int):
+        """Correct a reservation once the real token usage is known."""
+        if self.tokens:
+            with self._buckets_lock:
+                self.tokens.take(used - reserved)
+
+    def pause(self, seconds: float):
+        """Hold back every request for a while, e.g. after a 429 with retry-after."""
+        with self._buckets_lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            for bucket in (self.requests, self.tokens):
+                if bucket:
+                    bucket.take(max(bucket.level, 0) + seconds * bucket.rate)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, maximum: float = 60.0) -> float:
+    """Exponential backoff with full jitter for the given retry attempt (from 0)."""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
@@ -0,0 +1,149 @@
+"""
+Oldest-first queue of audio segments waiting to be transcribed.
+"""
+
+import datetime
+import heapq
+import itertools
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+import listener
+
+FILENAME_FORMATS = ("%Y-%m-%d %H-%M-%S-%f", "%Y-%m-%d %H-%M-%S")
+
+
+@dataclass(order=True)
+class Segment:
+    """
+    A captured segment, either a recording file or 16 kHz audio in memory.
+    """
+    timestamp: datetime.datetime
+    sequence: int
+    path: Optional[str] = field(default=None, compare=False)
+    audio: Optional[np.ndarray] = field(default=None, compare=False, repr=False)
+    # failed attempts at transcribing the segment
+    attempts: int = field(default=0, compare=False)
+
+    def load(self) -> np.ndarray:
+        """Return the segment audio as 16 kHz mono float32, reading it if needed."""
+        if self.audio is None:
+            self.audio = listener.load_audio(self.path, listener.WHISPER_SAMPLE_RATE)
+        return self.audio
+
+    @property
+    def duration(self) -> float:
+        """Length of the loaded audio in seconds."""
+        return len(self.load()) / listener.WHISPER_SAMPLE_RATE
+
+
+class UnreadableSegment(Exception):
+    """
+    The oldest segment could not be read. It has been taken off the queue.
+    """
+
+    def __init__(self, segment: Segment, error: Exception):
+        super().__init__(str(error))
+        self.segment = segment
+
+
+def recording_timestamp(path: str) -> datetime.datetime:
+    """Capture time of a recording, from its file name or else its mtime."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    for fmt in FILENAME_FORMATS:
+        try:
+            return datetime.datetime.strptime(name, fmt)
+        except ValueError:
+            continue
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path))
+
+
+class SegmentQueue:
+    """
+    Priority queue of pending segments ordered by capture time.
+
+    Recording files stay on disk until their text has been stored, so the
+    queue can always be rebuilt from the recordings directory after a restart.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._paths = set()
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def put_file(self, path: str):
+        """Queue a recording file, ignoring files that are already queued."""
+        if path in self._paths:
+            return
+        try:
+            timestamp = recording_timestamp(path)
+        except OSError:
+            return
+        self._paths.add(path)
+        heapq.heappush(self._heap, Segment(timestamp, next(self._sequence), path=path))
+
+    def put_audio(self, audio: np.ndarray, timestamp: datetime.datetime):
+        """Queue a segment that is already in memory."""
+        heapq.heappush(self._heap, Segment(timestamp, next(self._sequence), audio=audio))
+
+    def pop(self) -> Segment:
+        """Remove and return the oldest segment."""
+        segment = heapq.heappop(self._heap)
+        if segment.path:
+            self._paths.discard(segment.path)
+        return segment
+
+    def requeue(self, segment: Segment):
+        """Put back a segment that was popped but not processed."""
+        if segment.path:
+            self._paths.add(segment.path)
+        heapq.heappush(self._heap, segment)
+
+    def pop_batch(
+        self, max_duration: float, max_segments: int, gap: float = 0.0
+    ) -> list[Segment]:
+        """
+        Remove the oldest segments that fit into one model call.
+
+        Always returns at least one segment, or raises UnreadableSegment if it
+        cannot be read. Further segments are added oldest first while their
+        combined length, plus ``gap`` seconds between each of them, stays
+        within ``max_duration``.
+        """
+        batch = [self.pop()]
+        try:
+            total = batch[0].duration
+        # pylint: disable=broad-except
+        except Exception as e:
+            raise UnreadableSegment(batch[0], e) from e
+        while self._heap and len(batch) < max_segments:
+            candidate = self._heap[0]
+            try:
+                duration = candidate.duration
+            except (OSError, RuntimeError):
+                # unreadable file, let the caller deal with it on its own
+                break
+            if total + gap + duration > max_duration:
+                break
+            batch.append(self.pop())
+            total += gap + duration
+        return batch
+
+    def lag(self) -> float:
+        """Seconds since the oldest pending segment was captured."""
+        if not self._heap:
+            return 0.0
+        return (datetime.datetime.now() - self._heap[0].timestamp).total_seconds()
+
+    def in_memory(self) -> list[Segment]:
+        """Remove and return all segments that only exist in memory."""
+        memory_only = [segment for segment in self._heap if segment.path is None]
+        self._heap = [segment for segment in self._heap if segment.path is not None]
+        heapq.heapify(self._heap)
+        return sorted(memory_only)
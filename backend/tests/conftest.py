@@ -0,0 +1,8 @@
+"""
+Makes the backend modules importable from the tests, wherever pytest is run from.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,103 @@
+"""
+Tests for the leases and the commit order of the job queue.
+"""
+
+import time
+
+import pytest
+
+from job_queue import JobQueue
+
+LEASE = 0.05
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"), lease_seconds=LEASE, retry_base=0, retry_max=0)
+    yield queue
+    queue.close()
+
+
+def test_enqueue_is_idempotent(queue):
+    assert queue.enqueue("batch", "a", {"n": 1})
+    assert not queue.enqueue("batch", "a", {"n": 2})
+    assert queue.counts("batch") == {"pending": 1}
+
+
+def test_expired_lease_is_claimed_again(queue):
+    queue.enqueue("batch", "a", {})
+    first = queue.claim("first", "batch")
+    assert queue.claim("second", "batch") is None
+
+    time.sleep(LEASE * 2)
+    second = queue.claim("second", "batch")
+    assert second.id == first.id
+    assert second.attempts == 2
+
+    # the first worker has been fenced off
+    assert not first.renew()
+    assert not queue.finish(first, {"by": "first"})
+    assert queue.finish(second, {"by": "second"})
+
+
+def test_expired_lease_on_last_attempt_fails(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"), lease_seconds=LEASE, max_attempts=1)
+    queue.enqueue("batch", "a", {})
+    assert queue.claim("first", "batch") is not None
+
+    time.sleep(LEASE * 2)
+    assert queue.claim("second", "batch") is None
+    assert queue.counts("batch") == {"failed": 1}
+    queue.close()
+
+
+def test_expired_commit_lease_is_taken_over(queue):
+    queue.enqueue("batch", "a", {})
+    queue.finish(queue.claim("worker", "batch"), {})
+    first = queue.claim_in_order("first", "batch")
+    assert queue.claim_in_order("second", "batch") is None
+
+    time.sleep(LEASE * 2)
+    second = queue.claim_in_order("second", "batch")
+    assert second.id == first.id
+    assert not queue.complete(first)
+    assert queue.complete(second)
+
+
+def test_claim_in_order_commits_in_queue_order(queue):
+    for key in ("a", "b", "c"):
+        queue.enqueue("batch", key, {})
+    jobs = [queue.claim("worker", "batch") for _ in range(3)]
+    assert [job.key for job in jobs] == ["a", "b", "c"]
+
+    # later results wait for the oldest unfinished job
+    queue.finish(jobs[2], {})
+    queue.finish(jobs[1], {})
+    assert queue.claim_in_order("worker", "batch") is None
+
+    queue.finish(jobs[0], {})
+    committing = queue.claim_in_order("worker", "batch")
+    assert committing.key == "a"
+    # only one job is committed at a time
+    assert queue.claim_in_order("other", "batch") is None
+
+    queue.complete(committing)
+    committing = queue.claim_in_order("worker", "batch")
+    assert committing.key == "b"
+    assert committing.result == {}
+    queue.complete(committing)
+    assert queue.claim_in_order("worker", "batch").key == "c"
+
+
+def test_claim_in_order_skips_failed_jobs(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"), max_attempts=1)
+    queue.enqueue("batch", "a", {})
+    queue.enqueue("batch", "b", {})
+    first = queue.claim("worker", "batch")
+    second = queue.claim("worker", "batch")
+
+    queue.fail(first, "broken")
+    queue.finish(second, {})
+    assert queue.claim_in_order("worker", "batch").key == "b"
+    assert [job.key for job in queue.unfinished("batch")] == ["a", "b"]
+    queue.close()
@@ -0,0 +1,51 @@
+"""
+Tests for how WriteBatch combines writes to overlapping paths.
+"""
+
+from local_database import InMemoryDatabase
+
+
+def test_write_inside_written_path_is_folded_into_it():
+    db = InMemoryDatabase()
+    batch = db.batch()
+    key = batch.create("memories", {"topic": "hiking", "summary": "old"})
+    batch.update("memories", key, {"summary": "new", "image_url": "http://image"})
+
+    assert batch.updates == {
+        f"memories/{key}": {"topic": "hiking", "summary": "new", "image_url": "http://image"}
+    }
+    batch.commit()
+    assert db.get_memory(key) == {"topic": "hiking", "summary": "new", "image_url": "http://image"}
+
+
+def test_write_over_path_drops_earlier_writes_inside_it():
+    db = InMemoryDatabase({"memories": {"m1": {"topic": "hiking"}}})
+    batch = db.batch()
+    batch.update("memories", "m1", {"summary": "new"})
+    batch.delete("memories", "m1")
+
+    assert batch.updates == {"memories/m1": None}
+    batch.commit()
+    assert db.get_memory("m1") is None
+
+
+def test_write_into_deleted_path_keeps_only_the_write():
+    db = InMemoryDatabase({"memories": {"m1": {"topic": "hiking", "summary": "old"}}})
+    batch = db.batch()
+    batch.delete("memories", "m1")
+    batch.update("memories", "m1", {"summary": "new"})
+
+    assert batch.updates == {"memories/m1": {"summary": "new"}}
+    batch.commit()
+    assert db.get_memory("m1") == {"summary": "new"}
+
+
+def test_sibling_with_the_same_prefix_is_not_folded():
+    batch = InMemoryDatabase().batch()
+    batch.set("memories/m1", {"topic": "hiking"})
+    batch.update("memories", "m10", {"summary": "other"})
+
+    assert batch.updates == {
+        "memories/m1": {"topic": "hiking"},
+        "memories/m10/summary": "other",
+    }
@@ -0,0 +1,177 @@
+"""
+Timing spans and Prometheus metrics for the memory, image and transcription pipelines.
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# print each finished run as one JSON line
+TRACE_LOG = os.getenv("PIPELINE_TRACE_LOG", "1") == "1"
+
+# from a cache hit up to a slow staged run over a large backlog
+BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_seconds",
+    "Time spent in each stage of a pipeline",
+    ["pipeline", "stage"],
+    buckets=BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "pipeline_stage_errors_total",
+    "Pipeline stages that ended with an exception",
+    ["pipeline", "stage"],
+)
+PIPELINE_ITEMS = Counter(
+    "pipeline_items_total",
+    "Items handled by a pipeline, e.g. transcriptions processed or images generated",
+    ["pipeline", "item"],
+)
+LLM_CALL_SECONDS = Histogram(
+    "llm_call_seconds",
+    "Duration of LLM API calls, by the stage that made them",
+    ["model", "stage"],
+    buckets=BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Tokens used by LLM API calls, by the stage that made them",
+    ["model", "stage", "kind"],
+)
+LLM_CACHE_HITS = Counter(
+    "llm_cache_hits_total",
+    "LLM calls answered from the response cache",
+    ["model", "stage"],
+)
+TRANSCRIBER_QUEUE_DEPTH = Gauge(
+    "transcriber_queue_depth", "Segments waiting to be transcribed"
+)
+TRANSCRIBER_LAG_SECONDS = Gauge(
+    "transcriber_lag_seconds", "Age of the oldest segment waiting to be transcribed"
+)
+
+
+@dataclass
+class Span:
+    """
+    One timed stage of a pipeline run, with its sub-stages as children.
+    """
+    pipeline: str
+    name: str
+    parent: Optional["Span"] = field(default=None, repr=False)
+    attributes: dict = field(default_factory=dict)
+    children: list = field(default_factory=list, repr=False)
+    started: float = field(default_factory=time.perf_counter)
+    duration: Optional[float] = None
+    error: Optional[str] = None
+
+    def set(self, **attributes):
+        """Attach values to the span."""
+        with _lock:
+            self.attributes.update(attributes)
+
+    def add(self, **counts):
+        """Add to counters on this span and every span it is part of."""
+        with _lock:
+            span_ = self
+            while span_ is not None:
+                for key, value in counts.items():
+                    span_.attributes[key] = span_.attributes.get(key, 0) + value
+                span_ = span_.parent
+
+    def to_dict(self) -> dict:
+        """The span and its children as plain data."""
+        data = {
+            "name": self.name,
+            "seconds": round(self.duration, 4) if self.duration is not None else None,
+            **{
+                key: round(value, 4) if isinstance(value, float) else value
+                for key, value in self.attributes.items()
+            },
+        }
+        if self.error:
+            data["error"] = self.error
+        if self.children:
+            data["children"] = [child.to_dict() for child in self.children]
+        return data
+
+
+_lock = threading.Lock()
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+def current_span() -> Optional[Span]:
+    """The innermost span that is open in this context."""
+    return _current.get()
+
+
+@contextmanager
+def span(pipeline: str, name: str, **attributes):
+    """
+    Time a stage of a pipeline as a child of the span that is open, if any.
+
+    The duration goes into the ``pipeline_stage_seconds`` histogram, and an
+    outermost span with sub-stages is printed as one JSON line when it ends.
+    Work handed to other threads stays attached to the span when it is
+    submitted through ``contextvars.copy_context().run``.
+    """
+    parent = _current.get()
+    current = Span(pipeline, name, parent, attributes)
+    if parent is not None:
+        with _lock:
+            parent.children.append(current)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        STAGE_ERRORS.labels(pipeline, name).inc()
+        raise
+    finally:
+        _current.reset(token)
+        current.duration = time.perf_counter() - current.started
+        STAGE_SECONDS.labels(pipeline, name).observe(current.duration)
+        if parent is None and TRACE_LOG and (current.children or current.error):
+            print(f"[trace] {pipeline} {json.dumps(current.to_dict())}")
+
+
+def count(pipeline: str, item: str, amount: int = 1):
+    """Count items handled by a pipeline."""
+    if amount:
+        PIPELINE_ITEMS.labels(pipeline, item).inc(amount)
+
+
+def record_llm_call(
+    model: str, seconds: float, prompt_tokens: int = 0, completion_tokens: int = 0
+):
+    """Record an LLM API call against the stage that is running."""
+    current = _current.get()
+    stage = current.name if current else "none"
+    LLM_CALL_SECONDS.labels(model, stage).observe(seconds)
+    LLM_TOKENS.labels(model, stage, "prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(model, stage, "completion").inc(completion_tokens)
+    if current is not None:
+        current.add(
+            llm_calls=1,
+            llm_seconds=seconds,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+        )
+
+
+def record_llm_cache_hit(model: str):
+    """Record an LLM call that was answered from the cache."""
+    current = _current.get()
+    LLM_CACHE_HITS.labels(model, current.name if current else "none").inc()
+    if current is not None:
+        current.add(llm_cache_hits=1)
@@ -1,59 +1,394 @@
 """
 Transcribes audio recordings and processes the text into topic-grouped conversations.
-Uses MLX Whisper for transcription and LLaMA for topic extraction.
+Uses Whisper (MLX, openai-whisper or CTranslate2) for transcription and LLaMA for topic extraction.
 """
 
-import glob
+import argparse
 
 # import json
 import os
 import datetime
+import queue
+import threading
+import time
 
-import mlx_whisper
+import numpy as np
 from dotenv import load_dotenv
+from prometheus_client import start_http_server
 
+import listener
+from chunking import merge_seam, split_windows, window_text
 from database import Database
+from segment_queue import Segment, SegmentQueue, UnreadableSegment
+from tracing import TRANSCRIBER_LAG_SECONDS, TRANSCRIBER_QUEUE_DEPTH, count, span
+from transcription_cache import DEFAULT_PATH, TranscriptionCache, audio_key
+from watcher import RecordingsWatcher
+from whisper_backends import BACKENDS, TranscriberConfig, TranscriptionPool
 
 # from ollama import chat
 # from ollama import ChatResponse
 
 load_dotenv(override=True)
 
+# segments the listener may hand over in memory before it spills to disk
+HANDOFF_QUEUE_SIZE = 16
+# short segments are packed into one model call up to Whisper's 30 s window
+BATCH_MAX_DURATION = 30.0
+BATCH_MAX_SEGMENTS = 8
+# silence inserted between packed segments
+BATCH_GAP_DURATION = 0.5
+# longer segments are transcribed as overlapping windows
+WINDOW_DURATION = 30.0
+WINDOW_OVERLAP = 4.0
+# a segment that fails this many times is left until the transcriber restarts
+SEGMENT_MAX_ATTEMPTS = 3
 
-db = Database()
+RECORDINGS_DIR = "recordings"
+CACHE_PATH = os.getenv("TRANSCRIPTION_CACHE_PATH", DEFAULT_PATH)
+# serve Prometheus metrics on this port when set
+METRICS_PORT = os.getenv("TRANSCRIBER_METRICS_PORT")
 
-recordings_dir = os.path.join("recordings", "*")
 
-transcribed = {}
+def pack_batch(batch: list[Segment]) -> tuple[np.ndarray, list[float]]:
+    """
+    Join several segments into one array for a single model call.
 
-while True:
-    files = sorted(glob.iglob(recordings_dir), key=os.path.getctime, reverse=True)
-    if len(files) < 1:
-        continue
+    The segments are separated by short gaps of silence. Returns the audio
+    and the offset in seconds at which each segment starts.
+    """
+    if len(batch) == 1:
+        return batch[0].load(), [0.0]
 
-    latest_recording = files[0]
-    latest_recording_filename = latest_recording.split("/")[1]
+    rate = listener.WHISPER_SAMPLE_RATE
+    gap = np.zeros(int(rate * BATCH_GAP_DURATION), dtype=np.float32)
+    parts = []
+    offsets = []
+    position = 0.0
+    for segment in batch:
+        offsets.append(position)
+        parts.extend([segment.load(), gap])
+        position += segment.duration + BATCH_GAP_DURATION
+    return np.concatenate(parts), offsets
 
-    if os.path.exists(latest_recording) and not latest_recording in transcribed:
-        # result = mlx_whisper.transcribe(
-        #     latest_recording,
-        #     path_or_hf_repo="mlx-community/whisper-turbo"
-        # )
-        result = mlx_whisper.transcribe(
-            latest_recording, path_or_hf_repo="mlx-community/whisper-small.en-mlx"
-        )
 
-        text = result["text"]
+def split_result(result: dict, offsets: list[float]) -> list[str]:
+    """Map the timestamped segments of a packed transcription back to its inputs."""
+    if len(offsets) == 1:
+        return [result["text"].strip()]
+
+    texts = [[] for _ in offsets]
+    for piece in result.get("segments", []):
+        middle = (piece["start"] + piece["end"]) / 2
+        index = int(np.searchsorted(offsets, middle, side="right")) - 1
+        texts[max(index, 0)].append(piece["text"])
+    return ["".join(text).strip() for text in texts]
+
 
+def store_transcriptions(db: Database, texts: list[str]):
+    """Save transcriptions to the database in one request."""
+    if not texts:
+        return
+
+    for text in texts:
         print(text)
 
-        os.remove(latest_recording)
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S")
+
+    new_transcriptions = [{"text": text, "timestamp": timestamp} for text in texts]
+
+    db.create_transcriptions(new_transcriptions)
+
+
+def retry_later(pending: SegmentQueue, segment: Segment, error: Exception):
+    """Put a segment that failed back on the queue, unless it has failed too often."""
+    segment.attempts += 1
+    if segment.attempts >= SEGMENT_MAX_ATTEMPTS:
+        # a recording file stays on disk, so it is tried again after a restart
+        print(
+            f"Giving up on segment {segment.path or segment.timestamp} "
+            f"after {segment.attempts} attempts: {error}"
+        )
+        count("transcriber", "failed")
+        return
+    print(f"Error transcribing segment, retrying it later: {error}")
+    pending.requeue(segment)
+
+
+def process_next_batches(
+    db: Database,
+    pool: TranscriptionPool,
+    pending: SegmentQueue,
+    watcher: RecordingsWatcher,
+    cache: TranscriptionCache,
+):
+    """
+    Transcribe the oldest pending segments, store them and delete their files.
+
+    One batch is taken per pool worker so all of them stay busy; results are
+    stored oldest first regardless of which worker finishes first. Segments
+    whose audio is already in the cache skip the model, and segments whose
+    text already reached the database are only cleaned up. Segments that
+    fail are put back on the queue to be tried again.
+    """
+    started = time.perf_counter()
+    max_segments = BATCH_MAX_SEGMENTS if pool.supports_packing else 1
+
+    jobs = []
+    calls = 0
+    while pending and calls < pool.workers:
+        try:
+            batch = pending.pop_batch(BATCH_MAX_DURATION, max_segments, BATCH_GAP_DURATION)
+        except UnreadableSegment as e:
+            # the file may still be being written, try it again on the next round
+            retry_later(pending, e.segment, e)
+            break
+        if batch[0].duration > BATCH_MAX_DURATION:
+            # long segments get the whole pool to themselves
+            if jobs:
+                pending.requeue(batch[0])
+                break
+            try:
+                process_long_segment(db, pool, batch[0], watcher, cache)
+            # pylint: disable=broad-except
+            except Exception as e:
+                retry_later(pending, batch[0], e)
+            return
+        keys = [audio_key(segment.load(), pool.model_id) for segment in batch]
+
+        cached = [cache.get(key) for key in keys]
+        misses = [segment for segment, hit in zip(batch, cached) if hit is None]
+        future = None
+        offsets = []
+        if misses:
+            audio, offsets = pack_batch(misses)
+            future = pool.submit(audio)
+            calls += 1
+        jobs.append((batch, keys, cached, offsets, future))
+
+    done = []
+    texts = []
+    for batch, keys, cached, offsets, future in jobs:
+        try:
+            with span("transcriber", "transcribe", segments=len(batch)):
+                fresh = iter(split_result(future.result(), offsets) if future else [])
+        # pylint: disable=broad-except
+        except Exception as e:
+            for segment in batch:
+                retry_later(pending, segment, e)
+            continue
+        for segment, key, hit in zip(batch, keys, cached):
+            if hit is None:
+                text, stored = next(fresh), False
+                cache.put(key, pool.model_id, text)
+            else:
+                text, stored = hit
+                count("transcriber", "cache_hits")
+            if text and not stored:
+                texts.append(text)
+            done.append((segment, key))
+
+    with span("transcriber", "store", transcriptions=len(texts)):
+        store_transcriptions(db, texts)
+
+    for segment, key in done:
+        cache.mark_stored(key)
+        if segment.path:
+            os.remove(segment.path)
+            watcher.forget(segment.path)
+
+    count("transcriber", "segments", len(done))
+    TRANSCRIBER_QUEUE_DEPTH.set(len(pending))
+    TRANSCRIBER_LAG_SECONDS.set(pending.lag())
+    print(
+        f"Transcribed {len(done)} segment(s) in {calls} call(s) "
+        f"in {time.perf_counter() - started:.2f}s, "
+        f"queue depth: {len(pending)}, lag: {pending.lag():.1f}s, "
+        f"cache hits: {cache.stats['hits']}"
+    )
+
+
+def process_long_segment(
+    db: Database,
+    pool: TranscriptionPool,
+    segment: Segment,
+    watcher: RecordingsWatcher,
+    cache: TranscriptionCache,
+):
+    """
+    Transcribe a long segment as overlapping windows, storing each in order.
+
+    All windows are submitted at once so the pool works on them in parallel,
+    and their text is stitched at the seams. A window is stored as soon as it
+    and the windows before it are done, and marked stored in the cache, so a
+    retry after a failure only transcribes and stores the windows that are
+    left.
+    """
+    started = time.perf_counter()
+    windows = split_windows(
+        segment.load(), listener.WHISPER_SAMPLE_RATE, WINDOW_DURATION, WINDOW_OVERLAP
+    )
+    keys = [audio_key(audio, pool.model_id) for _offset, audio in windows]
+    cached = [cache.get(key) for key in keys]
+    futures = [
+        pool.submit(audio) if hit is None else None
+        for (_offset, audio), hit in zip(windows, cached)
+    ]
+
+    previous = ""
+    try:
+        for index, (key, hit, future) in enumerate(zip(keys, cached, futures)):
+            if hit is None:
+                with span("transcriber", "transcribe", window=index):
+                    result = future.result()
+                text = window_text(result, index, len(windows), WINDOW_DURATION, WINDOW_OVERLAP)
+                text, stored = merge_seam(previous, text), False
+                cache.put(key, pool.model_id, text)
+            else:
+                text, stored = hit
+            if text and not stored:
+                with span("transcriber", "store", window=index):
+                    store_transcriptions(db, [text])
+            cache.mark_stored(key)
+            previous = text or previous
+    except BaseException:
+        for future in futures:
+            if future is not None:
+                future.cancel()
+        raise
+
+    if segment.path:
+        os.remove(segment.path)
+        watcher.forget(segment.path)
+
+    count("transcriber", "segments")
+    print(
+        f"Transcribed a {segment.duration:.0f}s segment in {len(windows)} window(s) "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+
+
+def collect_segments(
+    pending: SegmentQueue, watcher: RecordingsWatcher, handoff: queue.Queue | None = None
+):
+    """Move newly finished segments onto the queue, waiting if there is no work."""
+    if handoff is not None:
+        try:
+            if pending:
+                pending.put_audio(*handoff.get_nowait())
+            else:
+                pending.put_audio(*handoff.get(timeout=0.5))
+            while True:
+                pending.put_audio(*handoff.get_nowait())
+        except queue.Empty:
+            pass
+        paths = watcher.poll()
+    else:
+        paths = watcher.poll() if pending else watcher.wait()
+
+    for path in paths:
+        pending.put_file(path)
+
+
+def watch_recordings(db: Database, pool: TranscriptionPool, cache: TranscriptionCache):
+    """Transcribe recordings oldest first as the listener writes them to disk."""
+    watcher = RecordingsWatcher(RECORDINGS_DIR)
+    pending = SegmentQueue()
+    for path in watcher.existing():
+        pending.put_file(path)
+
+    try:
+        while True:
+            collect_segments(pending, watcher)
+            if pending:
+                with span("transcriber", "batch"):
+                    process_next_batches(db, pool, pending, watcher, cache)
+    finally:
+        watcher.close()
+
+
+def run_in_process(db: Database, pool: TranscriptionPool, cache: TranscriptionCache):
+    """
+    Run the listener in this process and transcribe its segments from memory.
+
+    Segments arrive as float32 arrays, so nothing is encoded, written or read
+    back. Files only show up in the recordings directory when the listener
+    spills because the handoff queue is full; both kinds are transcribed
+    oldest first from the same queue.
+    """
+    handoff = queue.Queue(maxsize=HANDOFF_QUEUE_SIZE)
+    stop = threading.Event()
+    recorder = threading.Thread(
+        target=listener.stream_record,
+        kwargs={"handoff": handoff, "stop": stop},
+        name="listener",
+    )
+    recorder.start()
+
+    watcher = RecordingsWatcher(RECORDINGS_DIR)
+    pending = SegmentQueue()
+    for path in watcher.existing():
+        pending.put_file(path)
+
+    try:
+        while recorder.is_alive() or pending or not handoff.empty():
+            collect_segments(pending, watcher, handoff)
+            if pending:
+                with span("transcriber", "batch"):
+                    process_next_batches(db, pool, pending, watcher, cache)
+    except KeyboardInterrupt:
+        print("Transcriber interrupted by user.")
+    finally:
+        stop.set()
+        recorder.join()
+        watcher.close()
+        # keep whatever is still queued in memory for the next run
+        while not handoff.empty():
+            pending.put_audio(*handoff.get_nowait())
+        for segment in pending.in_memory():
+            listener.save_recording(segment.audio, segment.timestamp, listener.WHISPER_SAMPLE_RATE)
+
+
+def main():
+    """Transcribe recordings from disk, or from an in-process listener."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="run the listener in this process and hand segments over in memory",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(BACKENDS),
+        default=os.getenv("TRANSCRIBE_BACKEND", TranscriberConfig.backend),
+    )
+    parser.add_argument("--model", default=os.getenv("TRANSCRIBE_MODEL"))
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("TRANSCRIBE_WORKERS", str(TranscriberConfig.workers))),
+        help="worker processes, each with its own copy of the model",
+    )
+    args = parser.parse_args()
 
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S")
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT))
+    db = Database()
+    pool = TranscriptionPool(
+        TranscriberConfig(backend=args.backend, model=args.model, workers=args.workers)
+    )
+    cache = TranscriptionCache(CACHE_PATH)
+    try:
+        if args.in_process:
+            run_in_process(db, pool, cache)
+        else:
+            watch_recordings(db, pool, cache)
+    finally:
+        pool.shutdown()
+        cache.close()
 
-        new_transcription = {"text": text, "timestamp": timestamp}
 
-        db.create_transcription(new_transcription)
+if __name__ == "__main__":
+    main()
 
 
 #         print("<transcribe>\n", text, "\n</transcribe>")
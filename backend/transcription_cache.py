@@ -0,0 +1,85 @@
+"""
+On-disk cache of transcriptions keyed by audio content and model.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+# next to this file, so the transcriber and the API server share the cache
+# whatever directory they are started in
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcription_cache.db")
+
+
+def audio_key(audio: np.ndarray, model_id: str) -> str:
+    """Hash of the audio samples and the model that transcribes them."""
+    digest = hashlib.sha256(model_id.encode())
+    digest.update(np.ascontiguousarray(audio, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+class TranscriptionCache:
+    """
+    Remembers the text of every segment that has been transcribed.
+
+    Entries are written as soon as the model returns and flagged once the
+    text has been saved to the database, so after a crash a segment is
+    neither transcribed nor stored twice.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS transcriptions (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                text TEXT NOT NULL,
+                stored INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, key: str) -> Optional[tuple[str, bool]]:
+        """Return ``(text, stored)`` for a cached segment, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text, stored FROM transcriptions WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return row[0], bool(row[1])
+
+    def put(self, key: str, model_id: str, text: str):
+        """Cache the text of a freshly transcribed segment."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO transcriptions (key, model, text, stored, created) "
+                "VALUES (?, ?, ?, 0, ?)",
+                (key, model_id, text, time.time()),
+            )
+            self._conn.commit()
+
+    def mark_stored(self, key: str):
+        """Record that the segment's text has been saved to the database."""
+        with self._lock:
+            self._conn.execute("UPDATE transcriptions SET stored = 1 WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
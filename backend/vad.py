@@ -0,0 +1,122 @@
+"""
+Incremental voice-activity detection for the listener.
+"""
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+
+@dataclass
+class VADConfig:
+    """
+    Config for the voice-activity detector.
+
+    Thresholds are RMS levels of float audio in [-1, 1]. Speech starts once the
+    level stays above ``start_threshold`` for ``min_speech_duration`` and stops
+    once it stays below ``stop_threshold`` for ``min_silence_duration``.
+    """
+    start_threshold: float = 0.01
+    stop_threshold: float = 0.01
+    min_speech_duration: float = 0.5
+    min_silence_duration: float = 2.0
+    # number of blocks averaged into the level, 1 means no smoothing
+    smoothing_blocks: int = 1
+    # measure only the energy inside the speech band instead of the whole signal
+    spectral: bool = False
+    band_low_hz: float = 300.0
+    band_high_hz: float = 3400.0
+
+
+class VoiceActivityDetector:
+    """
+    Decides block by block whether the input contains speech.
+
+    Each block is reduced to one energy value and kept in a running sum over
+    the smoothing window, so the work per block never depends on how much
+    history the decision covers.
+    """
+
+    def __init__(self, config: VADConfig, sample_rate: int, block_size: int):
+        self.config = config
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+
+        block_duration = block_size / sample_rate
+        self.min_speech_blocks = max(1, round(config.min_speech_duration / block_duration))
+        self.min_silence_blocks = max(1, round(config.min_silence_duration / block_duration))
+        self._start_energy = config.start_threshold ** 2
+        self._stop_energy = config.stop_threshold ** 2
+
+        self._energies = deque(maxlen=max(1, config.smoothing_blocks))
+        self._energy_sum = 0.0
+        self._band_masks = {}
+
+        self.is_speech = False
+        self.speech_blocks = 0
+        self.silence_blocks = 0
+
+    def reset(self):
+        """Forget all history and return to the silent state."""
+        self._energies.clear()
+        self._energy_sum = 0.0
+        self.is_speech = False
+        self.speech_blocks = 0
+        self.silence_blocks = 0
+
+    @property
+    def level(self) -> float:
+        """Smoothed RMS level over the last few blocks."""
+        if not self._energies:
+            return 0.0
+        return float(np.sqrt(max(self._energy_sum, 0.0) / len(self._energies)))
+
+    def block_energy(self, block: np.ndarray) -> float:
+        """Mean-square energy of one block, optionally limited to the speech band."""
+        if not self.config.spectral:
+            return float(np.dot(block, block)) / len(block)
+
+        spectrum = np.fft.rfft(block)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        # Parseval: one-sided bins count twice towards the mean-square energy
+        return 2.0 * float(np.sum(power[self._band_mask(len(block))])) / len(block) ** 2
+
+    def _band_mask(self, n: int) -> np.ndarray:
+        mask = self._band_masks.get(n)
+        if mask is None:
+            freqs = np.fft.rfftfreq(n, d=1.0 / self.sample_rate)
+            mask = (freqs >= self.config.band_low_hz) & (freqs <= self.config.band_high_hz)
+            self._band_masks[n] = mask
+        return mask
+
+    def process(self, block: np.ndarray) -> Optional[str]:
+        """
+        Feed one block of mono audio.
+
+        Returns "start" when speech has just been confirmed, "stop" when
+        silence has just been confirmed and None otherwise. On "start",
+        ``speech_blocks`` holds how many blocks ago the speech began.
+        """
+        if len(self._energies) == self._energies.maxlen:
+            self._energy_sum -= self._energies[0]
+        energy = self.block_energy(block)
+        self._energies.append(energy)
+        self._energy_sum += energy
+        smoothed = self._energy_sum / len(self._energies)
+
+        if not self.is_speech:
+            self.speech_blocks = self.speech_blocks + 1 if smoothed > self._start_energy else 0
+            if self.speech_blocks >= self.min_speech_blocks:
+                self.is_speech = True
+                self.silence_blocks = 0
+                return "start"
+            return None
+
+        self.silence_blocks = self.silence_blocks + 1 if smoothed <= self._stop_energy else 0
+        if self.silence_blocks >= self.min_silence_blocks:
+            self.is_speech = False
+            self.speech_blocks = 0
+            return "stop"
+        return None
@@ -0,0 +1,177 @@
+"""
+Watches the recordings directory for finished segment files.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# the listener writes to "<name>.part" and renames the file once it is complete
+AUDIO_EXTENSIONS = (".wav", ".flac")
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_Q_OVERFLOW = 0x00004000
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def is_recording_file(name: str) -> bool:
+    """Whether a file name looks like a finished recording."""
+    return name.lower().endswith(AUDIO_EXTENSIONS) and not name.startswith(".")
+
+
+class RecordingsWatcher:
+    """
+    Reports recordings once they have been completely written.
+
+    On Linux this blocks on inotify and only wakes up when a file is closed
+    after writing or renamed into the directory. Elsewhere, or if inotify is
+    unavailable, it polls the directory and reports a file once its size and
+    modification time have stayed the same for one poll interval.
+    """
+
+    def __init__(self, directory: str, poll_interval: float = 1.0, use_inotify: bool = True):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self._fd = None
+        self._seen = set()
+        self._sizes = {}
+
+        os.makedirs(directory, exist_ok=True)
+        if use_inotify and sys.platform.startswith("linux"):
+            self._fd = self._init_inotify()
+        print(f"Watching {directory} using {'inotify' if self._fd is not None else 'polling'}")
+
+    def _init_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            wd = libc.inotify_add_watch(
+                fd, os.fsencode(self.directory), _IN_CLOSE_WRITE | _IN_MOVED_TO
+            )
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            return fd
+        # pylint: disable=broad-except
+        except Exception as e:
+            print(f"inotify unavailable, falling back to polling: {e}")
+            return None
+
+    def existing(self) -> list[str]:
+        """Recordings already in the directory, oldest first."""
+        paths = [
+            entry.path
+            for entry in os.scandir(self.directory)
+            if entry.is_file() and is_recording_file(entry.name)
+        ]
+        paths.sort(key=self._mtime)
+        self._seen.update(paths)
+        return paths
+
+    def forget(self, path: str):
+        """Stop tracking a recording, e.g. after it has been deleted."""
+        self._seen.discard(path)
+        self._sizes.pop(path, None)
+
+    def wait(self, timeout: float | None = None) -> list[str]:
+        """
+        Block until new recordings are complete and return their paths.
+
+        Returns an empty list if nothing arrived within ``timeout`` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if self._fd is not None:
+                paths = self._read_events(remaining)
+            else:
+                paths = self._poll(remaining)
+            if paths or (deadline is not None and time.monotonic() >= deadline):
+                return paths
+
+    def poll(self) -> list[str]:
+        """Return recordings completed since the last call without blocking."""
+        return self.wait(timeout=0)
+
+    def close(self):
+        """Release the inotify descriptor."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read_events(self, timeout: float | None) -> list[str]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            _wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+
+            if mask & _IN_Q_OVERFLOW:
+                # events were lost, rescan so nothing is missed
+                paths.extend(self.existing_unseen())
+                continue
+            if not is_recording_file(name):
+                continue
+            path = os.path.join(self.directory, name)
+            if path not in self._seen:
+                self._seen.add(path)
+                paths.append(path)
+        return paths
+
+    def existing_unseen(self) -> list[str]:
+        """Recordings in the directory that have not been reported yet."""
+        seen = set(self._seen)
+        return [path for path in self.existing() if path not in seen]
+
+    def _poll(self, timeout: float | None) -> list[str]:
+        paths = []
+        current = set()
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not is_recording_file(entry.name):
+                continue
+            current.add(entry.path)
+            if entry.path in self._seen:
+                continue
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if stat.st_size and self._sizes.get(entry.path) == signature:
+                self._seen.add(entry.path)
+                self._sizes.pop(entry.path)
+                paths.append(entry.path)
+            else:
+                self._sizes[entry.path] = signature
+
+        # drop files that disappeared before they settled
+        for path in list(self._sizes):
+            if path not in current:
+                del self._sizes[path]
+
+        if not paths and timeout != 0:
+            time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+        paths.sort(key=self._mtime)
+        return paths
+
+    @staticmethod
+    def _mtime(path: str) -> float:
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0.0
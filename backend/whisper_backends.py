@@ -0,0 +1,193 @@
+"""
+Speech-to-text backends and a process pool to run them in parallel.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+
+@dataclass
+class TranscriberConfig:
+    """
+    Config for the transcription backend.
+    """
+    # "mlx" (Apple Silicon), "whisper" (openai-whisper) or "ctranslate2" (faster-whisper)
+    backend: str = "mlx"
+    # model name or path, None uses the backend's default
+    model: Optional[str] = None
+    # number of worker processes, 1 transcribes on a thread in this process
+    workers: int = 1
+    # CTranslate2 quantization, int8 is the fastest on CPU
+    compute_type: str = "int8"
+
+
+class TranscriptionBackend:
+    """
+    Base class for speech-to-text engines.
+
+    ``transcribe`` takes 16 kHz mono float32 audio and returns a dict with
+    the full "text" and a list of timestamped "segments".
+    """
+    default_model = ""
+    # whether segment timestamps are reliable enough to pack several inputs into one call
+    supports_packing = True
+
+    def __init__(self, config: TranscriberConfig):
+        self.config = config
+        self.model_name = config.model or self.default_model
+
+    def transcribe(self, audio: np.ndarray) -> dict:
+        """Transcribe one array of audio."""
+        raise NotImplementedError
+
+
+class MLXWhisperBackend(TranscriptionBackend):
+    """
+    Whisper on Apple Silicon through MLX.
+    """
+    default_model = "mlx-community/whisper-small.en-mlx"
+
+    def __init__(self, config: TranscriberConfig):
+        super().__init__(config)
+        # pylint: disable=import-outside-toplevel
+        import mlx_whisper
+
+        self._mlx_whisper = mlx_whisper
+
+    def transcribe(self, audio: np.ndarray) -> dict:
+        # result = mlx_whisper.transcribe(
+        #     audio,
+        #     path_or_hf_repo="mlx-community/whisper-turbo"
+        # )
+        return self._mlx_whisper.transcribe(audio, path_or_hf_repo=self.model_name)
+
+
+class OpenAIWhisperBackend(TranscriptionBackend):
+    """
+    The reference openai-whisper implementation on PyTorch.
+    """
+    default_model = "base"
+
+    def __init__(self, config: TranscriberConfig):
+        super().__init__(config)
+        # pylint: disable=import-outside-toplevel
+        import whisper
+
+        self._model = whisper.load_model(self.model_name)
+
+    def transcribe(self, audio: np.ndarray) -> dict:
+        return self._model.transcribe(audio, fp16=False)
+
+
+class CTranslate2Backend(TranscriptionBackend):
+    """
+    Whisper converted to CTranslate2 (faster-whisper), quantized for the CPU.
+    """
+    default_model = "small.en"
+
+    def __init__(self, config: TranscriberConfig):
+        super().__init__(config)
+        # pylint: disable=import-outside-toplevel
+        from faster_whisper import WhisperModel
+
+        threads = max(1, (os.cpu_count() or 1) // max(1, config.workers))
+        self._model = WhisperModel(
+            self.model_name,
+            device="cpu",
+            compute_type=config.compute_type,
+            cpu_threads=threads,
+        )
+
+    def transcribe(self, audio: np.ndarray) -> dict:
+        pieces, _info = self._model.transcribe(audio, beam_size=1)
+        segments = [
+            {"start": piece.start, "end": piece.end, "text": piece.text} for piece in pieces
+        ]
+        return {"text": "".join(segment["text"] for segment in segments), "segments": segments}
+
+
+BACKENDS = {
+    "mlx": MLXWhisperBackend,
+    "whisper": OpenAIWhisperBackend,
+    "ctranslate2": CTranslate2Backend,
+}
+
+
+def create_backend(config: TranscriberConfig) -> TranscriptionBackend:
+    """Load the backend named in the config."""
+    return BACKENDS[config.backend](config)
+
+
+_worker_backend: Optional[TranscriptionBackend] = None
+
+
+def _init_worker(config: TranscriberConfig):
+    # pylint: disable=global-statement
+    global _worker_backend
+    _worker_backend = create_backend(config)
+
+
+def _transcribe_in_worker(audio: np.ndarray) -> dict:
+    return _worker_backend.transcribe(audio)
+
+
+class TranscriptionPool:
+    """
+    Runs a transcription backend on a pool of workers.
+
+    Every worker process loads the model once when it starts. With a single
+    worker the model is loaded in this process and calls run on one thread,
+    which is what GPU backends such as MLX want.
+    """
+
+    def __init__(self, config: TranscriberConfig):
+        if config.backend not in BACKENDS:
+            raise ValueError(
+                f"Unknown transcription backend: {config.backend} "
+                f"(expected one of {', '.join(BACKENDS)})"
+            )
+        self.config = config
+        self.supports_packing = BACKENDS[config.backend].supports_packing
+
+        if config.workers > 1:
+            self._executor = ProcessPoolExecutor(
+                max_workers=config.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(config,),
+            )
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix="transcriber",
+                initializer=_init_worker,
+                initargs=(config,),
+            )
+
+    @property
+    def model_id(self) -> str:
+        """Backend and model name, e.g. for cache keys."""
+        backend = BACKENDS[self.config.backend]
+        return f"{self.config.backend}:{self.config.model or backend.default_model}"
+
+    @property
+    def workers(self) -> int:
+        """Number of segments that can be transcribed at the same time."""
+        return max(1, self.config.workers)
+
+    def submit(self, audio: np.ndarray) -> Future:
+        """Queue audio for transcription and return a future of the result dict."""
+        return self._executor.submit(_transcribe_in_worker, audio)
+
+    def transcribe(self, audio: np.ndarray) -> dict:
+        """Transcribe audio and wait for the result."""
+        return self.submit(audio).result()
+
+    def shutdown(self):
+        """Stop the workers once their current work is done."""
+        self._executor.shutdown(wait=True)